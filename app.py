@@ -1,33 +1,53 @@
 import os
 import re
+import json
 import math
+import time
+import uuid
 import threading
 import requests
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for, session
 from werkzeug.security import generate_password_hash, check_password_hash
 import database
 import config
+import model_registry
 
-from ml_budget import budget_model  # may load empty if grids not yet built
-from ml_eta import eta_model        # same — lazy-reload kicks in on first predict()
+from ml_budget import budget_model  # may load empty if models not yet built
+from ml_eta import eta_model        # same — the model watcher swaps trained versions in
+
+# ── Safety: train missing models in background; the watcher swaps them in ────
+model_watcher = model_registry.ModelWatcher([budget_model, eta_model])
 
-# ── Safety: train missing grids in background, then reload singletons ─────────
 def _ensure_models():
-    budget_path = os.path.join('models', 'budget_rf.pkl')
-    eta_path    = os.path.join('models', 'eta_grid.json')
-    if not os.path.exists(budget_path) or not os.path.exists(eta_path):
+    if model_registry.current_version('budget') and model_registry.current_version('eta'):
+        return
+    import train_models
+    # Every gunicorn worker runs this: one trains and publishes, the others wait and find the result
+    with train_models.training_lock():
+        missing_budget = model_registry.current_version('budget') is None
+        missing_eta = model_registry.current_version('eta') is None
+        if not (missing_budget or missing_eta):
+            model_watcher.check_now()
+            return
         print("[ML] Models missing — training in background (app stays live)...")
-        from train_models import train_budget_ml_model, generate_eta_grid
         os.makedirs('models', exist_ok=True)
-        if not os.path.exists(budget_path):
-            train_budget_ml_model()
-        if not os.path.exists(eta_path):
-            generate_eta_grid()
-        # Hot-reload the singletons so they're immediately usable
-        budget_model._load()
-        eta_model._load()
-        print("[ML] Background training complete — models live.")
-
+        if missing_budget:
+            if not os.path.exists(train_models.BUDGET_MODEL_PATH):
+                train_models.train_budget_ml_model()
+            elif not os.path.exists(train_models.BUDGET_FOREST_PATH):
+                train_models.export_budget_forest()
+            train_models.publish_budget_model()
+        if missing_eta:
+            if not os.path.exists(train_models.ETA_GRID_PATH):
+                train_models.generate_eta_grid()
+            if not os.path.exists(train_models.ETA_FACTORS_PATH):
+                train_models.export_eta_factors()
+            train_models.publish_eta_model()
+        # Swap the new versions in without waiting for the next poll
+        model_watcher.check_now()
+        print("[ML] Background training complete — models published.")
+
+model_watcher.start()
 threading.Thread(target=_ensure_models, daemon=True).start()
 
 
@@ -171,6 +191,42 @@ def admin_stats_api():
     return jsonify(metrics)
 
 
+@app.route('/api/admin/model-memory')
+def admin_model_memory_api():
+    """Per-worker resident vs shared memory of the ETA grid (admin only)."""
+    if not session.get('is_admin'):
+        return jsonify({"status": "error"}), 403
+    return jsonify({
+        "status": "success",
+        "eta_grid": eta_model.memory_report(),
+        "versions": {"eta": eta_model.version, "budget": budget_model.version}
+    })
+
+
+@app.route('/api/admin/prediction-cache')
+def admin_prediction_cache_api():
+    """Hit/miss/eviction counters of this worker's budget predict() cache (admin only)."""
+    if not session.get('is_admin'):
+        return jsonify({"status": "error"}), 403
+    return jsonify({
+        "status": "success",
+        "pid": os.getpid(),
+        "budget": dict(budget_model.cache_stats(), version=budget_model.version)
+    })
+
+
+@app.route('/api/admin/db-pool')
+def admin_db_pool_api():
+    """Connection-pool and activity-log writer counters of this worker (admin only)."""
+    if not session.get('is_admin'):
+        return jsonify({"status": "error"}), 403
+    return jsonify({
+        "status": "success",
+        "pool": database.pool_stats(),
+        "activity_log": database.activity_log_stats()
+    })
+
+
 @app.route('/api/admin/delete-user', methods=['POST'])
 def admin_delete_user():
     """Admin only: deletes a user."""
@@ -329,6 +385,7 @@ def get_trips_api():
         return jsonify({"status": "error", "message": "Not logged in"}), 401
 
     trips = database.get_user_trips(session["user_id"])
+    spent = database.get_user_trip_spend(session["user_id"])
     trips_list = [
         {
             "id": t[0],
@@ -338,7 +395,8 @@ def get_trips_api():
             "end_date": t[5],
             "budget": t[6],
             "latitude": t[7],
-            "longitude": t[8]
+            "longitude": t[8],
+            "total_spent": spent.get(t[0], 0.0)
         } for t in trips
     ]
     return jsonify({"status": "success", "trips": trips_list})
@@ -479,8 +537,10 @@ def get_expenses_api(trip_id):
     if trip[1] != session["user_id"]:
         return jsonify({"status": "error", "message": "Not authorized"}), 403
 
-    expenses = database.get_expenses(trip_id)
-    total_spent = sum(e[3] for e in expenses) # e[3] is 'amount'
+    # Totals come from the materialized per-trip sums; rows only when they are shown (?list=0 skips them)
+    spend = database.get_trip_spend(trip_id)
+    total_spent = spend["total_spent"]
+    expenses = database.get_expenses(trip_id) if request.args.get('list', '1') != '0' else None
     
     # --- ENHANCEMENT: Return budget details ---
     # trip[6] is the 'budget' column from the 'trips' table
@@ -492,6 +552,8 @@ def get_expenses_api(trip_id):
         "status": "success",
         "expenses": expenses,
         "total_spent": total_spent,
+        "expense_count": spend["expense_count"],
+        "by_category": spend["by_category"],
         "trip_budget": trip_budget,
         "remaining_budget": remaining_budget
     })
@@ -518,7 +580,7 @@ def predict_budget_api():
             return jsonify({"status": "error", "message": "Days and group size must be positive"}), 400
 
         # Query the advanced Hypercube Budget engine (v3 — family discount aware)
-        total_budget = budget_model.predict(
+        estimate = budget_model.predict_breakdown(
             days=days,
             travel_style=hotel_style,
             food_type=food_type,
@@ -529,17 +591,138 @@ def predict_budget_api():
             is_family=is_family,
             destination=destination
         )
+        total_budget = estimate['estimated_budget']
 
         return jsonify({
             "status": "success",
             "estimated_budget": total_budget,
             "cost_per_person": round(total_budget / group_size, 2) if group_size > 0 else total_budget,
+            "breakdown": estimate['breakdown'],
+            "model": estimate['model'],
             "days": days,
             "stay_type": stay_type
         })
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+# Upper bound on trips per batch request (keeps one forest call bounded)
+BUDGET_BATCH_LIMIT = 500
+
+@app.route('/api/predict-budget/batch', methods=['POST'])
+def predict_budget_batch_api():
+    """Predict budgets for many trip specs in one round trip via budget_model.predict_many."""
+    if not request.is_json:
+        return jsonify({"status": "error", "message": "Invalid request: Must be JSON"}), 400
+
+    try:
+        data = request.get_json()
+        trips = data.get('trips')
+        if not isinstance(trips, list) or not trips:
+            return jsonify({"status": "error", "message": "trips must be a non-empty list"}), 400
+        if len(trips) > BUDGET_BATCH_LIMIT:
+            return jsonify({"status": "error", "message": f"At most {BUDGET_BATCH_LIMIT} trips per batch"}), 400
+
+        days = [int(t.get('days', 1)) for t in trips]
+        group_size = [int(t.get('group_size', 1)) for t in trips]
+        if min(days) <= 0 or min(group_size) <= 0:
+            return jsonify({"status": "error", "message": "Days and group size must be positive"}), 400
+
+        budgets = budget_model.predict_many(
+            days=days,
+            travel_style=[t.get('travel_style', 'mid') for t in trips],
+            food_type=[t.get('food_type', 'dhaba') for t in trips],
+            group_size=group_size,
+            season=[t.get('season', 'shoulder') for t in trips],
+            booking=[t.get('booking', 'normal') for t in trips],
+            stay_type=[t.get('stay_type', 'budget_hotel') for t in trips],
+            is_family=[bool(t.get('is_family', False)) for t in trips],
+            destination=[t.get('destination', '') for t in trips]
+        )
+
+        return jsonify({
+            "status": "success",
+            "estimated_budgets": budgets.tolist(),
+            "cost_per_person": [round(total / grp, 2) for total, grp in zip(budgets.tolist(), group_size)]
+        })
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+
+@app.route('/api/predict-budget/scenarios', methods=['POST'])
+def predict_budget_scenarios_api():
+    """
+    Budget for every stay type x food type x season x booking of one trip,
+    so the Plan Trip form can compare options locally without re-requesting.
+    """
+    if not request.is_json:
+        return jsonify({"status": "error", "message": "Invalid request: Must be JSON"}), 400
+
+    data = request.get_json()
+    try:
+        days = int(data.get('days', 1))
+        group_size = int(data.get('group_size', 1))
+        if days <= 0 or group_size <= 0:
+            return jsonify({"status": "error", "message": "Days and group size must be positive"}), 400
+
+        axes, budgets = budget_model.scenario_matrix(
+            days=days,
+            group_size=group_size,
+            travel_style=data.get('travel_style', 'mid'),
+            is_family=bool(data.get('is_family', False)),
+            destination=data.get('destination', '')
+        )
+
+        return jsonify({
+            "status": "success",
+            "days": days,
+            "group_size": group_size,
+            "axes": axes,
+            "axis_order": list(axes),
+            "estimated_budgets": budgets.tolist()  # indexed in axis_order
+        })
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+# Largest number of plans the optimizer will return
+BUDGET_OPTIMIZE_MAX_K = 20
+
+@app.route('/api/predict-budget/optimize', methods=['POST'])
+def optimize_budget_api():
+    """Top-K most comfortable stay/food/style/booking plans that fit under a budget cap."""
+    if not request.is_json:
+        return jsonify({"status": "error", "message": "Invalid request: Must be JSON"}), 400
+
+    data = request.get_json()
+    try:
+        budget_cap = float(data.get('budget', 0))
+        days = int(data.get('days', 1))
+        group_size = int(data.get('group_size', 1))
+        top_k = max(1, min(BUDGET_OPTIMIZE_MAX_K, int(data.get('top_k', 5))))
+        if budget_cap <= 0 or days <= 0 or group_size <= 0:
+            return jsonify({"status": "error", "message": "Budget, days and group size must be positive"}), 400
+
+        plans, stats = budget_model.optimize(
+            budget_cap=budget_cap,
+            days=days,
+            group_size=group_size,
+            season=data.get('season', 'shoulder'),
+            is_family=bool(data.get('is_family', False)),
+            destination=data.get('destination', ''),
+            top_k=top_k
+        )
+        for plan in plans:
+            plan['cost_per_person'] = round(plan['estimated_budget'] / group_size, 2)
+
+        return jsonify({
+            "status": "success",
+            "budget": budget_cap,
+            "plans": plans,
+            "search": stats
+        })
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
 
 # ------------------
 # 6. ETA PREDICTION API
@@ -556,12 +739,16 @@ def predict_eta_api():
         hour_of_day = int(data.get('hour_of_day', 12))
         day_type = data.get('day_type', 'weekday')
         weather = data.get('weather', 'clear')
+        vehicle = data.get('vehicle', 'sedan')
+        terrain = data.get('terrain', 'highway')
         
         duration_mins = eta_model.predict(
             distance_km=distance_km,
             hour_of_day=hour_of_day,
             day_type=day_type,
-            weather=weather
+            weather=weather,
+            vehicle=vehicle,
+            terrain=terrain
         )
         
         return jsonify({
@@ -571,6 +758,282 @@ def predict_eta_api():
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 400
 
+def _fastest_windows(durations):
+    """Contiguous [start_hour, end_hour] runs whose duration equals the day's minimum."""
+    best = min(durations)
+    windows = []
+    for hour, minutes in enumerate(durations):
+        if minutes != best:
+            continue
+        if windows and windows[-1][1] == hour - 1:
+            windows[-1][1] = hour
+        else:
+            windows.append([hour, hour])
+    return windows
+
+@app.route('/api/predict-eta/departures', methods=['POST'])
+def predict_eta_departures_api():
+    """'Best time to leave': predicted duration for every hour of weekday and weekend."""
+    if 'user_id' not in session:
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+
+    try:
+        data = request.json
+        distance_km = float(data.get('distance_km', 0))
+        matrix = eta_model.departure_matrix(
+            distance_km=distance_km,
+            weather=data.get('weather', 'clear'),
+            vehicle=data.get('vehicle', 'sedan'),
+            terrain=data.get('terrain', 'highway')
+        )
+
+        durations, windows = {}, {}
+        for day_type, row in zip(eta_model.day_types(), matrix.tolist()):
+            durations[day_type] = row
+            windows[day_type] = _fastest_windows(row)
+        day_idx, hour = divmod(int(matrix.argmin()), matrix.shape[-1])
+
+        return jsonify({
+            "status": "success",
+            "distance_km": distance_km,
+            "durations": durations,
+            "fastest_windows": windows,
+            "fastest": {
+                "day_type": eta_model.day_types()[day_idx],
+                "hour_of_day": hour,
+                "duration_minutes": float(matrix[day_idx, hour])
+            }
+        })
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+# Upper bound on legs per batch request (keeps one request's gather bounded)
+ETA_BATCH_LIMIT = 500
+
+@app.route('/api/predict-eta/batch', methods=['POST'])
+def predict_eta_batch_api():
+    """Predict ETAs for many legs in one round trip via eta_model.predict_many."""
+    if 'user_id' not in session:
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+
+    try:
+        data = request.get_json()
+        queries = data.get('queries')
+        if not isinstance(queries, list) or not queries:
+            return jsonify({"status": "error", "message": "queries must be a non-empty list"}), 400
+        if len(queries) > ETA_BATCH_LIMIT:
+            return jsonify({"status": "error", "message": f"At most {ETA_BATCH_LIMIT} queries per batch"}), 400
+
+        durations = eta_model.predict_many(
+            distance_km=[float(q.get('distance_km', 0)) for q in queries],
+            hour_of_day=[int(q.get('hour_of_day', 12)) for q in queries],
+            day_type=[q.get('day_type', 'weekday') for q in queries],
+            weather=[q.get('weather', 'clear') for q in queries],
+            vehicle=[q.get('vehicle', 'sedan') for q in queries],
+            terrain=[q.get('terrain', 'highway') for q in queries]
+        )
+
+        return jsonify({
+            "status": "success",
+            "duration_minutes": durations.tolist()
+        })
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+@app.route('/api/predict-eta/route', methods=['POST'])
+def predict_eta_route_api():
+    """Multi-leg route ETA: each leg has its own distance/terrain/vehicle and departs on arrival of the previous one."""
+    if 'user_id' not in session:
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+
+    try:
+        data = request.get_json()
+        legs = data.get('legs')
+        if not isinstance(legs, list) or not legs:
+            return jsonify({"status": "error", "message": "legs must be a non-empty list"}), 400
+        if len(legs) > ETA_BATCH_LIMIT:
+            return jsonify({"status": "error", "message": f"At most {ETA_BATCH_LIMIT} legs per route"}), 400
+
+        weather = data.get('weather', 'clear')
+        vehicle = data.get('vehicle', 'sedan')
+        hour_of_day = int(data.get('hour_of_day', 12))
+        minute = int(data.get('minute', 0))
+        day_of_week = data.get('day_of_week')
+
+        results = eta_model.predict_route(
+            distance_km=[float(leg.get('distance_km', 0)) for leg in legs],
+            vehicle=[leg.get('vehicle', vehicle) for leg in legs],
+            terrain=[leg.get('terrain', 'highway') for leg in legs],
+            weather=[leg.get('weather', weather) for leg in legs],
+            departure_minute=max(0, min(23, hour_of_day)) * 60 + max(0, min(59, minute)),
+            day_type=data.get('day_type', 'weekday'),
+            day_of_week=None if day_of_week is None else int(day_of_week)
+        )
+        for leg, result in zip(legs, results):
+            result['distance_km'] = float(leg.get('distance_km', 0))
+
+        return jsonify({
+            "status": "success",
+            "legs": results,
+            "total_minutes": round(results[-1]['arrive_minute'] - results[0]['depart_minute'], 1)
+        })
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+# ------------------
+# 6b. LIVE TRACKING ETA STREAM (SSE)
+# ------------------
+
+# Server-side throttle: each stream re-reads its session at most this often.
+# Clients push at most once a minute, so a tighter poll only burns queries.
+TRACK_POLL_SECONDS = 5.0
+TRACK_HEARTBEAT_SECONDS = 15.0
+# Streams end after this long; EventSource reconnects on its own
+TRACK_STREAM_MAX_SECONDS = 600.0
+# Every open stream pins a gthread worker thread, so cap them per process well
+# below --threads; past the cap the client takes ETAs from its position pushes.
+TRACK_MAX_STREAMS = int(os.environ.get('TRACK_MAX_STREAMS', '4'))
+# Sessions with no position push for this long are deleted (tab closed without /stop)
+TRACK_SESSION_TTL_SECONDS = 1800.0
+TRACK_EXPIRE_EVERY_SECONDS = 300.0
+
+_track_stream_slots = threading.BoundedSemaphore(TRACK_MAX_STREAMS)
+_track_expire_lock = threading.Lock()
+_track_last_expire = 0.0
+
+def _expire_stale_tracking():
+    """Prune abandoned tracking sessions, at most once per TRACK_EXPIRE_EVERY_SECONDS per process."""
+    global _track_last_expire
+    now = time.monotonic()
+    with _track_expire_lock:
+        if _track_last_expire and now - _track_last_expire < TRACK_EXPIRE_EVERY_SECONDS:
+            return
+        _track_last_expire = now
+    database.expire_tracking_sessions(TRACK_SESSION_TTL_SECONDS)
+
+def _tracking_eta(distance_km, hour_of_day, day_type, weather, vehicle, terrain):
+    return eta_model.predict(
+        distance_km=distance_km,
+        hour_of_day=12 if hour_of_day is None else hour_of_day,
+        day_type=day_type or 'weekday',
+        weather=weather or 'clear',
+        vehicle=vehicle or 'sedan',
+        terrain=terrain or 'highway'
+    )
+
+@app.route('/api/track/start', methods=['POST'])
+def track_start_api():
+    """Open a live tracking session; the client then pushes positions and listens on the stream."""
+    if 'user_id' not in session:
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+
+    _expire_stale_tracking()
+    data = request.get_json(silent=True) or {}
+    tracking_id = uuid.uuid4().hex
+    if not database.create_tracking_session(
+        tracking_id, session['user_id'],
+        weather=data.get('weather', 'clear'),
+        vehicle=data.get('vehicle', 'sedan'),
+        terrain=data.get('terrain', 'highway')
+    ):
+        return jsonify({"status": "error", "message": "Could not start tracking"}), 500
+    return jsonify({"status": "success", "tracking_id": tracking_id})
+
+@app.route('/api/track/<tracking_id>/position', methods=['POST'])
+def track_position_api(tracking_id):
+    """
+    Position push: stores the remaining distance. Clients without a stream
+    (all slots taken) send with_eta and get the prediction in the response.
+    """
+    if 'user_id' not in session:
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+
+    try:
+        data = request.get_json()
+        distance_km = float(data.get('distance_km', 0))
+        hour_of_day = int(data.get('hour_of_day', 12))
+        day_type = data.get('day_type', 'weekday')
+        updated = database.update_tracking_position(
+            tracking_id, session['user_id'],
+            distance_km=distance_km,
+            hour_of_day=hour_of_day,
+            day_type=day_type,
+            weather=data.get('weather')
+        )
+        if not updated:
+            return jsonify({"status": "error", "message": "Tracking session not found"}), 404
+        if not data.get('with_eta'):
+            return jsonify({"status": "success"})
+
+        row = database.get_tracking_session(tracking_id)
+        if row is None:
+            return jsonify({"status": "error", "message": "Tracking session not found"}), 404
+        _, _, _, _, _, weather, vehicle, terrain, _ = row
+        duration_mins = _tracking_eta(distance_km, hour_of_day, day_type, weather, vehicle, terrain)
+        return jsonify({"status": "success", "distance_km": distance_km, "duration_minutes": duration_mins})
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+@app.route('/api/track/<tracking_id>/stop', methods=['POST'])
+def track_stop_api(tracking_id):
+    if 'user_id' not in session:
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    database.end_tracking_session(tracking_id, session['user_id'])
+    return jsonify({"status": "success"})
+
+def _tracking_events(tracking_id):
+    """Yield SSE messages whenever the rounded ETA of a tracking session changes."""
+    last_version, last_sent = None, None
+    started = last_write = time.monotonic()
+    yield f"retry: {int(TRACK_POLL_SECONDS * 1000)}\n\n"
+
+    while time.monotonic() - started < TRACK_STREAM_MAX_SECONDS:
+        row = database.get_tracking_session(tracking_id)
+        if row is None:
+            yield "event: end\ndata: {}\n\n"
+            return
+
+        _, _, distance_km, hour_of_day, day_type, weather, vehicle, terrain, version = row
+        if version != last_version and distance_km is not None:
+            last_version = version
+            duration_mins = _tracking_eta(distance_km, hour_of_day, day_type, weather, vehicle, terrain)
+            if round(duration_mins) != last_sent:
+                last_sent = round(duration_mins)
+                last_write = time.monotonic()
+                payload = {"distance_km": distance_km, "duration_minutes": duration_mins}
+                yield f"data: {json.dumps(payload)}\n\n"
+
+        if time.monotonic() - last_write >= TRACK_HEARTBEAT_SECONDS:
+            last_write = time.monotonic()
+            yield ": keepalive\n\n"
+        time.sleep(TRACK_POLL_SECONDS)
+
+@app.route('/api/track/<tracking_id>/stream')
+def track_stream_api(tracking_id):
+    """
+    Server-sent ETA updates for one tracking session. Answers 503 once
+    TRACK_MAX_STREAMS are open in this process; EventSource does not retry a
+    non-200 response, and the client falls back to ETAs on its pushes.
+    """
+    if 'user_id' not in session:
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+
+    _expire_stale_tracking()
+    row = database.get_tracking_session(tracking_id)
+    if not row or row[1] != session['user_id']:
+        return jsonify({"status": "error", "message": "Tracking session not found"}), 404
+
+    if not _track_stream_slots.acquire(blocking=False):
+        return jsonify({"status": "error", "message": "Live stream capacity reached"}), 503
+
+    response = Response(_tracking_events(tracking_id), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # Runs when the server closes the response — stream ended or client gone
+    response.call_on_close(_track_stream_slots.release)
+    return response
+
 # ------------------
 # 7. INTELLIGENT CHATBOT API
 # ------------------
@@ -0,0 +1,208 @@
+"""
+Micro-benchmarks for the ML inference hot paths and the database layer.
+
+Run after `python train_models.py`:
+    python benchmarks.py
+"""
+import random
+import time
+
+
+def _per_call_us(fn, args_list, repeat=3):
+    """Best-of-`repeat` average cost of fn(*args) in microseconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for args in args_list:
+            fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best / len(args_list) * 1e6
+
+
+def bench_eta_bin_lookup(n=20000):
+    """Distance-bin resolution: linear min() scan vs binary search."""
+    from ml_eta import eta_model
+
+    bins = eta_model.dist_bins
+    if not bins:
+        print("ETA grid missing — run train_models.py first.")
+        return
+
+    def linear(d):
+        return min(range(len(bins)), key=lambda i: abs(bins[i] - d))
+
+    random.seed(0)
+    queries = [(random.uniform(0.1, bins[-1] * 1.2),) for _ in range(n)]
+    assert all(linear(*q) == eta_model._nearest_bin(*q) for q in queries[:2000])
+
+    linear_us = _per_call_us(linear, queries[:n // 10])
+    bisect_us = _per_call_us(eta_model._nearest_bin, queries)
+    predict_us = _per_call_us(eta_model.predict, [(q[0], 8) for q in queries])
+    print(f"ETA bin lookup ({len(bins)} bins): linear {linear_us:.1f} us/call, "
+          f"bisect {bisect_us:.2f} us/call ({linear_us / bisect_us:.0f}x)")
+    print(f"ETA predict end-to-end: {predict_us:.2f} us/call")
+
+
+def bench_budget_forest(n=2000):
+    """Budget forest: sklearn's predict vs the array-compiled evaluator, single rows and a batch."""
+    import numpy as np
+    from ml_budget import budget_model, BUDGET_COMPILED_MAX_ROWS, VALID_FOOD_TYPES, VALID_STAY_TYPES
+
+    engine = budget_model.engine
+    if engine.forest is None:
+        print("Compiled budget forest missing — run train_models.py first.")
+        return
+
+    random.seed(0)
+    rows = [{
+        'days': random.randint(1, 30), 'group_size': random.randint(1, 20),
+        'travel_style': random.choice(['budget', 'mid', 'luxury']),
+        'food_type': random.choice(VALID_FOOD_TYPES),
+        'season': random.choice(['peak', 'off-peak', 'shoulder', 'holiday']),
+        'booking': random.choice(['last-minute', 'normal', 'advance']),
+        'stay_type': random.choice(VALID_STAY_TYPES),
+    } for _ in range(n)]
+    X = np.vstack([engine.encoder.encode(row).copy() for row in rows])
+    assert np.array_equal(engine.forest.predict_many(X), engine.regressor.predict(X))
+
+    singles = [(x[None],) for x in X[:n // 10]]
+    sklearn_us = _per_call_us(engine.regressor.predict, singles)
+    compiled_us = _per_call_us(engine.forest.predict_one, [(x,) for x in X])
+    print(f"Budget forest single row: sklearn {sklearn_us:.0f} us/call, "
+          f"compiled {compiled_us:.0f} us/call ({sklearn_us / compiled_us:.0f}x)")
+
+    sklearn_batch = _per_call_us(engine.regressor.predict, [(X,)]) / n
+    compiled_batch = _per_call_us(engine.forest.predict_many, [(X,)]) / n
+    print(f"Budget forest batch of {n}: sklearn {sklearn_batch:.1f} us/row, "
+          f"compiled {compiled_batch:.1f} us/row")
+    cols = {k: [row[k] for row in rows] for k in rows[0]}
+    routed_batch = _per_call_us(engine._forest_cost_many, [(cols,)]) / n
+    print(f"Budget forest batch of {n} via _forest_cost_many (compiled up to "
+          f"{BUDGET_COMPILED_MAX_ROWS} rows, sklearn above): {routed_batch:.1f} us/row")
+
+
+def bench_budget_optimizer(n=50):
+    """Budget-capped plan search over the full option grid (target: well under 100 ms)."""
+    from ml_budget import budget_model
+
+    random.seed(0)
+    queries = [(random.uniform(5000, 150000), random.randint(1, 14), random.randint(1, 8))
+               for _ in range(n)]
+    per_call_ms = _per_call_us(budget_model.optimize, queries) / 1000
+    _, stats = budget_model.optimize(*queries[0])
+    print(f"Budget optimizer ({stats['evaluated']} candidates): {per_call_ms:.1f} ms/call")
+
+
+def _hammer_app(worker_id, seconds, start_barrier, results):
+    """One benchmark worker: alternate POST /add-expense and GET /get-trips for `seconds`."""
+    import database
+    from app import app
+
+    email = f"bench{worker_id}@example.com"
+    database.add_user(f"Bench {worker_id}", email, "x")
+    user_id = database.get_user_by_email(email)[0]
+    database.add_trip(user_id, "Bench trip", "Goa")
+    trip_id = database.get_user_trips(user_id)[0][0]
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+
+    latencies = {'add-expense': [], 'get-trips': []}
+    errors = 0
+    start_barrier.wait()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for name in latencies:
+            start = time.perf_counter()
+            if name == 'add-expense':
+                resp = client.post('/add-expense', json={'trip_id': trip_id, 'category': 'Food',
+                                                         'amount': 120, 'description': 'bench'})
+            else:
+                resp = client.get('/get-trips')
+            latencies[name].append(time.perf_counter() - start)
+            if resp.status_code != 200 or resp.get_json().get('status') != 'success':
+                errors += 1
+    results.put((latencies, errors))
+
+
+def bench_sqlite_concurrency(workers=4, seconds=5.0):
+    """
+    N worker processes (like gunicorn workers) hammering /add-expense and
+    /get-trips on one SQLite file: default profile vs SQLITE_PROFILE=production.
+    """
+    import multiprocessing
+    import os
+    import tempfile
+
+    ctx = multiprocessing.get_context('spawn')
+    for profile in ('default', 'production'):
+        with tempfile.TemporaryDirectory() as tmp:
+            env = {'SQLITE_PATH': os.path.join(tmp, 'bench.db'), 'SQLITE_PROFILE': profile}
+            saved = {k: os.environ.get(k) for k in list(env) + ['DATABASE_URL']}
+            os.environ.update(env)
+            os.environ.pop('DATABASE_URL', None)
+            try:
+                barrier = ctx.Barrier(workers)
+                results = ctx.Queue()
+                procs = [ctx.Process(target=_hammer_app, args=(i, seconds, barrier, results))
+                         for i in range(workers)]
+                for p in procs:
+                    p.start()
+                outcomes = [results.get() for _ in procs]
+                for p in procs:
+                    p.join()
+            finally:
+                for k, v in saved.items():
+                    if v is None:
+                        os.environ.pop(k, None)
+                    else:
+                        os.environ[k] = v
+
+        errors = sum(e for _, e in outcomes)
+        parts = []
+        for name in ('add-expense', 'get-trips'):
+            lat = sorted(x for l, _ in outcomes for x in l[name])
+            parts.append(f"{name} {len(lat) / seconds:.0f} req/s "
+                         f"p50 {lat[len(lat) // 2] * 1000:.1f} ms p99 {lat[int(len(lat) * 0.99)] * 1000:.1f} ms")
+        print(f"SQLite {profile} profile, {workers} workers: " + ", ".join(parts) + f", {errors} errors")
+
+
+def bench_activity_log_flush(rounds=5):
+    """Time from log_activity() to the row being in activity_logs on a quiet worker (bound: ~FLUSH_MS)."""
+    import os
+    import tempfile
+
+    os.environ['SQLITE_PATH'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ.pop('DATABASE_URL', None)
+    import database
+
+    flush_ms = database.ACTIVITY_LOG_FLUSH_MS
+    worst = 0.0
+    for i in range(rounds):
+        action = f'BENCH_FLUSH_{i}'
+        start = time.perf_counter()
+        database.log_activity(None, '127.0.0.1', '/bench', action)
+        while True:
+            conn, backend = database.get_conn()
+            cur = conn.cursor()
+            cur.execute(f"SELECT COUNT(*) FROM activity_logs WHERE action = {database._ph(backend)}", (action,))
+            landed = cur.fetchone()[0]
+            cur.close()
+            conn.close()
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if landed:
+                break
+            assert elapsed_ms < flush_ms * 2 + 500, f"row still pending after {elapsed_ms:.0f} ms"
+            time.sleep(0.01)
+        worst = max(worst, elapsed_ms)
+        time.sleep(flush_ms / 1000)  # let the writer go idle again between rounds
+    print(f"Activity log flush: single row lands in {worst:.0f} ms worst case (FLUSH_MS {flush_ms})")
+
+
+if __name__ == "__main__":
+    bench_eta_bin_lookup()
+    bench_budget_forest()
+    bench_budget_optimizer()
+    bench_sqlite_concurrency()
+    bench_activity_log_flush()
@@ -1,4 +1,10 @@
+import atexit
+import collections
+import datetime
 import os
+import sqlite3
+import threading
+import time
 
 DATABASE_URL = os.environ.get('DATABASE_URL', '')
 
@@ -9,32 +15,356 @@ if DATABASE_URL.startswith('postgres://'):
 # ── Decide backend ────────────────────────────────────────────────────────────
 USE_SQLITE_FALLBACK = not bool(DATABASE_URL)
 
+# SQLite file used when there is no DATABASE_URL (SQLITE_PATH overrides it)
+DB_PATH = os.environ.get('SQLITE_PATH') or os.path.join(os.path.dirname(__file__), 'users.db')
+
 if USE_SQLITE_FALLBACK:
-    import sqlite3
-    DB_PATH = os.path.join(os.path.dirname(__file__), 'users.db')
     print("[DB] Local development mode: using SQLite database.")
 else:
     try:
         import psycopg2
+        import psycopg2.extensions
         from psycopg2.extras import RealDictCursor
         print("[DB] PostgreSQL DATABASE_URL detected.")
     except ImportError:
         # psycopg2 not installed — fall back to SQLite
-        import sqlite3
-        DB_PATH = os.path.join(os.path.dirname(__file__), 'users.db')
         USE_SQLITE_FALLBACK = True
         print("[DB] psycopg2 not installed - falling back to SQLite.")
 
 
-def get_conn():
-    """Returns a live database connection (PostgreSQL or SQLite fallback)."""
+# ── Connection pool ──────────────────────────────────────────────────────────
+# PostgreSQL: bounded pool shared by the worker's threads.
+# SQLite: one persistent connection per thread.
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '10'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '30'))        # seconds to wait for a free connection
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', '30'))  # idle seconds before a SELECT 1 health check
+
+# Opt-in SQLite tuning for running several workers on one file
+# (SQLITE_PROFILE=production): WAL journal, synchronous=NORMAL, mmap, busy
+# timeout, enforced foreign keys, and one writer at a time per process.
+SQLITE_PROFILE = os.environ.get('SQLITE_PROFILE', 'default')
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection frees up within DB_POOL_TIMEOUT."""
+
+
+class _PooledConnection:
+    """
+    What get_conn() hands out: proxies the DB-API connection, and close()
+    returns it to the pool instead of closing it. A handle dropped without
+    close() (e.g. an exception before the helper's close) is released when
+    it is garbage-collected.
+    """
+    __slots__ = ('_conn', '_release')
+
+    def __init__(self, conn, release):
+        self._conn = conn
+        self._release = release
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._release(conn)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class _PGPool:
+    """Thread-safe bounded pool of psycopg2 connections with checkout health checks and wait metrics."""
+
+    def __init__(self, dsn, minconn, maxconn, timeout):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = max(1, maxconn)
+        self.timeout = timeout
+        self._idle = collections.deque()  # (conn, released_at); LIFO keeps few connections warm
+        self._size = 0                    # open connections, idle + checked out
+        self._cond = threading.Condition()
+        self.stats = {'checkouts': 0, 'waits': 0, 'wait_ms_total': 0.0, 'wait_ms_max': 0.0,
+                      'timeouts': 0, 'opened': 0, 'discarded': 0}
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn)
+        with self._cond:
+            self.stats['opened'] += 1
+        return conn
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _healthy(self, conn, released_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - released_at < DB_POOL_PING_AFTER:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        """Close a connection and give its slot back to the pool."""
+        self._close_quietly(conn)
+        with self._cond:
+            self._size -= 1
+            self.stats['discarded'] += 1
+            self._cond.notify()
+
+    def _warm_up(self, count):
+        """Open `count` idle connections into slots the caller already reserved."""
+        for opened in range(count):
+            try:
+                conn = self._connect()
+            except Exception:
+                # The caller's own connect reports the error; just free the slots
+                with self._cond:
+                    self._size -= count - opened
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def get(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        waited = False
+        warm = 0
+        with self._cond:
+            if self._size == 0 and self.minconn > 1:
+                # Warm up to the minimum on first use: reserve the slots now
+                # (the caller's own connection is the last one), connect below
+                # without holding the condition
+                warm = min(self.minconn, self.maxconn) - 1
+                self._size += warm
+            while True:
+                if self._idle:
+                    conn, released_at = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    conn, released_at = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    raise PoolTimeout(f"no database connection free within {self.timeout}s")
+                waited = True
+                self._cond.wait(remaining)
+
+            self.stats['checkouts'] += 1
+            if waited:
+                wait_ms = (time.monotonic() - start) * 1000
+                self.stats['waits'] += 1
+                self.stats['wait_ms_total'] += wait_ms
+                self.stats['wait_ms_max'] = max(self.stats['wait_ms_max'], wait_ms)
+
+        if warm:
+            self._warm_up(warm)
+        if conn is not None and not self._healthy(conn, released_at):
+            # Replace it within the slot we already hold, so no waiter can take it in between
+            self._close_quietly(conn)
+            with self._cond:
+                self.stats['discarded'] += 1
+            conn = None
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+        return conn
+
+    def checkout(self):
+        """(connection, release callback) for get_conn()."""
+        return self.get(), self.put
+
+    def put(self, conn):
+        try:
+            if conn.closed:
+                raise psycopg2.InterfaceError("connection closed")
+            # Helpers that only read never commit: end their transaction here
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def snapshot(self):
+        with self._cond:
+            return dict(self.stats, size=self._size, idle=len(self._idle),
+                        in_use=self._size - len(self._idle), max=self.maxconn)
+
+
+_SQLITE_WRITE_VERBS = frozenset(('INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'BEGIN', 'CREATE', 'DROP', 'ALTER'))
+
+
+class _SingleWriterCursor(sqlite3.Cursor):
+    def execute(self, sql, *args):
+        self.connection._before_statement(sql)
+        return super().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        self.connection._before_statement(sql)
+        return super().executemany(sql, *args)
+
+
+class _SingleWriterConnection(sqlite3.Connection):
+    """
+    sqlite3 connection for the production profile. The first write statement
+    of a transaction takes the process-wide writer lock, and commit/rollback
+    releases it. Writers therefore queue on an in-process lock instead of
+    retrying inside SQLite's busy handler, and WAL readers never wait on them.
+    """
+    write_lock = None
+    holds_write_lock = False
+
+    def cursor(self, factory=_SingleWriterCursor):
+        return super().cursor(factory)
+
+    def _before_statement(self, sql):
+        if self.holds_write_lock:
+            return
+        verb = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+        if verb in _SQLITE_WRITE_VERBS:
+            if not self.write_lock.acquire(timeout=SQLITE_BUSY_TIMEOUT_MS / 1000):
+                raise sqlite3.OperationalError("database is locked (single-writer queue timed out)")
+            self.holds_write_lock = True
+
+    def release_write_lock(self):
+        if self.holds_write_lock:
+            self.holds_write_lock = False
+            self.write_lock.release()
+
+    def commit(self):
+        try:
+            super().commit()
+        finally:
+            self.release_write_lock()
+
+    def rollback(self):
+        try:
+            super().rollback()
+        finally:
+            self.release_write_lock()
+
+
+class _SQLiteThreadConnections:
+    """One persistent sqlite3 connection per thread (sqlite3 objects must stay on their thread)."""
+
+    def __init__(self, profile='default'):
+        self.profile = profile
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self.stats = {'checkouts': 0, 'opened': 0}
+
+    def _connect(self):
+        if self.profile != 'production':
+            return sqlite3.connect(DB_PATH)
+        conn = sqlite3.connect(DB_PATH, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+                               factory=_SingleWriterConnection)
+        conn.write_lock = self._write_lock
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def get(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+            with self._lock:
+                self.stats['opened'] += 1
+        self._local.checkout = getattr(self._local, 'checkout', 0) + 1
+        with self._lock:
+            self.stats['checkouts'] += 1
+        return conn
+
+    def checkout(self):
+        """(connection, release callback) for get_conn(); the callback is tied to this checkout."""
+        conn = self.get()
+        checkout = self._local.checkout
+        return conn, lambda c: self.put(c, checkout)
+
+    def put(self, conn, checkout=None):
+        # Every handle on a thread wraps the same connection. A stale one (a
+        # leaked handle collected after a newer checkout, or collected on
+        # another thread) must not roll back or unlock the current request.
+        if checkout is not None and (getattr(self._local, 'conn', None) is not conn
+                                     or self._local.checkout != checkout):
+            return
+        if conn.in_transaction:
+            conn.rollback()
+        if isinstance(conn, _SingleWriterConnection):
+            # A write that failed before opening a transaction still holds the lock
+            conn.release_write_lock()
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, profile=self.profile)
+
+
+def _new_pool():
     if USE_SQLITE_FALLBACK:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        return conn, 'sqlite'
-    else:
-        conn = psycopg2.connect(DATABASE_URL)
-        return conn, 'pg'
+        return _SQLiteThreadConnections(SQLITE_PROFILE)
+    return _PGPool(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT)
+
+
+_pool = _new_pool()
+# Connections inherited across a fork are kept referenced but never used or
+# closed in the child: closing would tear down the parent's server session.
+_inherited_pools = []
+
+
+def _reset_pool_after_fork():
+    global _pool
+    _inherited_pools.append(_pool)
+    _pool = _new_pool()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_pool_after_fork)
+
+
+def get_conn():
+    """
+    Returns a database connection (PostgreSQL or SQLite fallback) from the
+    pool. Calling close() on it hands it back for reuse.
+    """
+    conn, release = _pool.checkout()
+    return _PooledConnection(conn, release), 'sqlite' if USE_SQLITE_FALLBACK else 'pg'
+
+
+def pool_stats():
+    """Checkout / wait counters and current size of this process's connection pool."""
+    return dict(_pool.snapshot(), backend='sqlite' if USE_SQLITE_FALLBACK else 'pg', pid=os.getpid())
 
 
 def _ph(backend):
@@ -43,14 +373,11 @@ def _ph(backend):
 
 
 # ─────────────────────────────────────────────────────────────────────────────
-# INIT DB — Creates all tables if they don't exist
+# SCHEMA MIGRATIONS — applied in order, once, tracked in schema_version
 # ─────────────────────────────────────────────────────────────────────────────
 
-def init_db():
-    """Create all tables (users, trips, expenses, activity_logs)."""
-    conn, backend = get_conn()
-    cur = conn.cursor()
-
+def _migration_base_tables(cur, backend):
+    """users, trips, expenses, activity_logs, plus the columns older databases lack."""
     if backend == 'pg':
         # PostgreSQL uses SERIAL instead of AUTOINCREMENT
         cur.execute('''
@@ -101,7 +428,7 @@ def init_db():
             )
         ''')
 
-        # PostgreSQL migrations (safe to run every time)
+        # Columns added after the first deployments
         cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='users'")
         user_cols = [r[0] for r in cur.fetchall()]
         if 'is_blocked' not in user_cols:
@@ -163,7 +490,7 @@ def init_db():
             )
         ''')
 
-        # SQLite migrations (safe to run every time)
+        # Columns added after the first deployments
         cur.execute("PRAGMA table_info(users)")
         cols = [r[1] for r in cur.fetchall()]
         if 'is_admin' not in cols:
@@ -178,9 +505,290 @@ def init_db():
         if 'stay_type' not in trip_cols:
             cur.execute("ALTER TABLE trips ADD COLUMN stay_type TEXT DEFAULT 'budget_hotel'")
 
-    conn.commit()
-    cur.close()
-    conn.close()
+
+def _migration_tracking_sessions(cur, backend):
+    if backend == 'pg':
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS tracking_sessions (
+                id          TEXT PRIMARY KEY,
+                user_id     INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+                distance_km REAL,
+                hour_of_day INTEGER,
+                day_type    TEXT DEFAULT 'weekday',
+                weather     TEXT DEFAULT 'clear',
+                vehicle     TEXT DEFAULT 'sedan',
+                terrain     TEXT DEFAULT 'highway',
+                version     INTEGER DEFAULT 0,
+                updated_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    else:
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS tracking_sessions (
+                id          TEXT PRIMARY KEY,
+                user_id     INTEGER NOT NULL,
+                distance_km REAL,
+                hour_of_day INTEGER,
+                day_type    TEXT DEFAULT 'weekday',
+                weather     TEXT DEFAULT 'clear',
+                vehicle     TEXT DEFAULT 'sedan',
+                terrain     TEXT DEFAULT 'highway',
+                version     INTEGER DEFAULT 0,
+                updated_at  DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+            )
+        ''')
+
+
+def _migration_query_indexes(cur, backend):
+    """Indexes behind per-user trip lists, per-trip expenses and the admin log views."""
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_trips_user_id ON trips(user_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_expenses_trip_id ON expenses(trip_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_activity_logs_timestamp ON activity_logs(timestamp)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_activity_logs_user_timestamp ON activity_logs(user_id, timestamp)")
+
+
+def _migration_trip_spend_totals(cur, backend):
+    """
+    Materialized spend per trip (trip_spend) and per trip and category
+    (trip_category_spend), kept in step with expenses by triggers, so every
+    insert, update and delete — cascades from trips/users included — adjusts
+    the totals in the same transaction. Existing expenses are backfilled.
+    """
+    if backend == 'pg':
+        # No expense writes between the backfill and the triggers going live
+        cur.execute("LOCK TABLE expenses IN SHARE ROW EXCLUSIVE MODE")
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS trip_spend (
+            trip_id       INTEGER PRIMARY KEY REFERENCES trips(id) ON DELETE CASCADE,
+            total         REAL NOT NULL DEFAULT 0,
+            expense_count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS trip_category_spend (
+            trip_id       INTEGER NOT NULL REFERENCES trips(id) ON DELETE CASCADE,
+            category      TEXT NOT NULL,
+            total         REAL NOT NULL DEFAULT 0,
+            expense_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (trip_id, category)
+        )
+    ''')
+
+    # Statements shared by both backends' triggers: subtract OLD / add NEW
+    remove_old = '''
+        UPDATE trip_spend SET total = total - COALESCE(OLD.amount, 0), expense_count = expense_count - 1
+        WHERE trip_id = OLD.trip_id;
+        UPDATE trip_category_spend SET total = total - COALESCE(OLD.amount, 0), expense_count = expense_count - 1
+        WHERE trip_id = OLD.trip_id AND category = COALESCE(OLD.category, '');
+    '''
+    add_new = '''
+        INSERT INTO trip_spend (trip_id, total, expense_count) VALUES (NEW.trip_id, COALESCE(NEW.amount, 0), 1)
+        ON CONFLICT (trip_id) DO UPDATE SET total = trip_spend.total + excluded.total,
+                                            expense_count = trip_spend.expense_count + 1;
+        INSERT INTO trip_category_spend (trip_id, category, total, expense_count)
+        VALUES (NEW.trip_id, COALESCE(NEW.category, ''), COALESCE(NEW.amount, 0), 1)
+        ON CONFLICT (trip_id, category) DO UPDATE SET total = trip_category_spend.total + excluded.total,
+                                                      expense_count = trip_category_spend.expense_count + 1;
+    '''
+    if backend == 'pg':
+        cur.execute(f'''
+            CREATE OR REPLACE FUNCTION expenses_sync_trip_spend() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    {remove_old}
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    {add_new}
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        ''')
+        cur.execute('''
+            CREATE TRIGGER expenses_trip_spend AFTER INSERT OR UPDATE OR DELETE ON expenses
+            FOR EACH ROW EXECUTE PROCEDURE expenses_sync_trip_spend()
+        ''')
+    else:
+        cur.execute(f"CREATE TRIGGER IF NOT EXISTS expenses_trip_spend_insert AFTER INSERT ON expenses BEGIN {add_new} END")
+        cur.execute(f"CREATE TRIGGER IF NOT EXISTS expenses_trip_spend_delete AFTER DELETE ON expenses BEGIN {remove_old} END")
+        cur.execute(f"CREATE TRIGGER IF NOT EXISTS expenses_trip_spend_update AFTER UPDATE OF trip_id, category, amount "
+                    f"ON expenses BEGIN {remove_old} {add_new} END")
+
+    # Backfill (expenses orphaned by trip deletes without FK enforcement have no trip to total)
+    cur.execute('''
+        INSERT INTO trip_spend (trip_id, total, expense_count)
+        SELECT trip_id, COALESCE(SUM(amount), 0), COUNT(*) FROM expenses
+        WHERE trip_id IN (SELECT id FROM trips)
+        GROUP BY trip_id
+    ''')
+    cur.execute('''
+        INSERT INTO trip_category_spend (trip_id, category, total, expense_count)
+        SELECT trip_id, COALESCE(category, ''), COALESCE(SUM(amount), 0), COUNT(*) FROM expenses
+        WHERE trip_id IN (SELECT id FROM trips)
+        GROUP BY trip_id, COALESCE(category, '')
+    ''')
+
+
+def _migration_tracking_expiry_index(cur, backend):
+    """Index behind expire_tracking_sessions, which prunes by updated_at."""
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tracking_sessions_updated_at ON tracking_sessions(updated_at)")
+
+
+def _migration_trip_spend_cents(cur, backend):
+    """
+    Rebuild trip_spend / trip_category_spend on integer cents. Migration 4's
+    REAL running sums drifted under ± updates (0.1 + 0.2 - 0.1 - 0.2 left
+    2.8e-17 behind); integer adds and subtracts are exact, so the totals
+    always equal the sum of the expenses' rounded cents. Recomputed from
+    expenses rather than converted from the drifted values.
+    """
+    if backend == 'pg':
+        cur.execute("LOCK TABLE expenses IN SHARE ROW EXCLUSIVE MODE")
+        cur.execute("DROP TRIGGER IF EXISTS expenses_trip_spend ON expenses")
+    else:
+        for trigger in ('expenses_trip_spend_insert', 'expenses_trip_spend_delete', 'expenses_trip_spend_update'):
+            cur.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    cur.execute("DROP TABLE IF EXISTS trip_category_spend")
+    cur.execute("DROP TABLE IF EXISTS trip_spend")
+
+    cur.execute('''
+        CREATE TABLE trip_spend (
+            trip_id       INTEGER PRIMARY KEY REFERENCES trips(id) ON DELETE CASCADE,
+            total_cents   BIGINT NOT NULL DEFAULT 0,
+            expense_count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE trip_category_spend (
+            trip_id       INTEGER NOT NULL REFERENCES trips(id) ON DELETE CASCADE,
+            category      TEXT NOT NULL,
+            total_cents   BIGINT NOT NULL DEFAULT 0,
+            expense_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (trip_id, category)
+        )
+    ''')
+
+    # expenses.amount stays REAL; each row contributes its amount rounded to cents
+    old_cents = "CAST(ROUND(COALESCE(OLD.amount, 0) * 100) AS BIGINT)"
+    new_cents = "CAST(ROUND(COALESCE(NEW.amount, 0) * 100) AS BIGINT)"
+    remove_old = f'''
+        UPDATE trip_spend SET total_cents = total_cents - {old_cents}, expense_count = expense_count - 1
+        WHERE trip_id = OLD.trip_id;
+        UPDATE trip_category_spend SET total_cents = total_cents - {old_cents}, expense_count = expense_count - 1
+        WHERE trip_id = OLD.trip_id AND category = COALESCE(OLD.category, '');
+    '''
+    add_new = f'''
+        INSERT INTO trip_spend (trip_id, total_cents, expense_count) VALUES (NEW.trip_id, {new_cents}, 1)
+        ON CONFLICT (trip_id) DO UPDATE SET total_cents = trip_spend.total_cents + excluded.total_cents,
+                                            expense_count = trip_spend.expense_count + 1;
+        INSERT INTO trip_category_spend (trip_id, category, total_cents, expense_count)
+        VALUES (NEW.trip_id, COALESCE(NEW.category, ''), {new_cents}, 1)
+        ON CONFLICT (trip_id, category) DO UPDATE SET total_cents = trip_category_spend.total_cents + excluded.total_cents,
+                                                      expense_count = trip_category_spend.expense_count + 1;
+    '''
+    if backend == 'pg':
+        cur.execute(f'''
+            CREATE OR REPLACE FUNCTION expenses_sync_trip_spend() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    {remove_old}
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    {add_new}
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        ''')
+        cur.execute('''
+            CREATE TRIGGER expenses_trip_spend AFTER INSERT OR UPDATE OR DELETE ON expenses
+            FOR EACH ROW EXECUTE PROCEDURE expenses_sync_trip_spend()
+        ''')
+    else:
+        cur.execute(f"CREATE TRIGGER expenses_trip_spend_insert AFTER INSERT ON expenses BEGIN {add_new} END")
+        cur.execute(f"CREATE TRIGGER expenses_trip_spend_delete AFTER DELETE ON expenses BEGIN {remove_old} END")
+        cur.execute(f"CREATE TRIGGER expenses_trip_spend_update AFTER UPDATE OF trip_id, category, amount "
+                    f"ON expenses BEGIN {remove_old} {add_new} END")
+
+    cur.execute('''
+        INSERT INTO trip_spend (trip_id, total_cents, expense_count)
+        SELECT trip_id, COALESCE(SUM(CAST(ROUND(amount * 100) AS BIGINT)), 0), COUNT(*) FROM expenses
+        WHERE trip_id IN (SELECT id FROM trips)
+        GROUP BY trip_id
+    ''')
+    cur.execute('''
+        INSERT INTO trip_category_spend (trip_id, category, total_cents, expense_count)
+        SELECT trip_id, COALESCE(category, ''), COALESCE(SUM(CAST(ROUND(amount * 100) AS BIGINT)), 0), COUNT(*)
+        FROM expenses
+        WHERE trip_id IN (SELECT id FROM trips)
+        GROUP BY trip_id, COALESCE(category, '')
+    ''')
+
+
+# (version, description, migration). Append only — never renumber or edit an applied one.
+MIGRATIONS = (
+    (1, 'base tables', _migration_base_tables),
+    (2, 'tracking_sessions', _migration_tracking_sessions),
+    (3, 'query indexes', _migration_query_indexes),
+    (4, 'trip spend totals', _migration_trip_spend_totals),
+    (5, 'tracking session expiry index', _migration_tracking_expiry_index),
+    (6, 'trip spend in integer cents', _migration_trip_spend_cents),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Key of the PostgreSQL advisory lock that serializes migrations across workers
+_MIGRATION_LOCK_KEY = 0x7B5C_0001
+
+
+def _schema_version(cur):
+    cur.execute("SELECT MAX(version) FROM schema_version")
+    return cur.fetchone()[0] or 0
+
+
+def init_db():
+    """
+    Bring the schema up to SCHEMA_VERSION. Pending migrations run in one
+    transaction under a lock (advisory lock on PostgreSQL, BEGIN IMMEDIATE on
+    SQLite), so concurrently booting workers apply each migration exactly
+    once. On an up-to-date database this is a single version query.
+    """
+    conn, backend = get_conn()
+    cur = conn.cursor()
+    ph = _ph(backend)
+    try:
+        try:
+            if _schema_version(cur) >= SCHEMA_VERSION:
+                return
+        except Exception:
+            conn.rollback()  # no schema_version table yet
+
+        if backend == 'pg':
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (_MIGRATION_LOCK_KEY,))
+        else:
+            cur.execute("BEGIN IMMEDIATE")
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version     INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # Another worker may have migrated while we waited for the lock
+        current = _schema_version(cur)
+        for version, description, migrate in MIGRATIONS:
+            if version > current:
+                migrate(cur, backend)
+                cur.execute(f"INSERT INTO schema_version (version, description) VALUES ({ph},{ph})",
+                            (version, description))
+                print(f"[DB] Applied schema migration {version}: {description}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
 
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -366,29 +974,213 @@ def get_expenses(trip_id):
     return [tuple(r) for r in data]
 
 
-# ─────────────────────────────────────────────────────────────────────────────
-# 4. ADMIN & ANALYTICS FUNCTIONS
-# ─────────────────────────────────────────────────────────────────────────────
+def get_trip_spend(trip_id):
+    """
+    Materialized spend of one trip: {'total_spent', 'expense_count',
+    'by_category': {category: total}}. Primary-key lookups only; no expense
+    rows are read. Totals are stored in integer cents.
+    """
+    conn, backend = get_conn()
+    cur = conn.cursor()
+    ph = _ph(backend)
+    cur.execute(f"SELECT total_cents, expense_count FROM trip_spend WHERE trip_id = {ph}", (trip_id,))
+    row = cur.fetchone()
+    cur.execute(f"SELECT category, total_cents FROM trip_category_spend WHERE trip_id = {ph} AND expense_count > 0",
+                (trip_id,))
+    by_category = {r[0]: r[1] / 100 for r in cur.fetchall()}
+    cur.close()
+    conn.close()
+    if row is None:
+        return {'total_spent': 0.0, 'expense_count': 0, 'by_category': {}}
+    return {'total_spent': row[0] / 100, 'expense_count': row[1], 'by_category': by_category}
 
-def log_activity(user_id, ip_address, endpoint, action):
+
+def get_user_trip_spend(user_id):
+    """{trip_id: total spent} for all of a user's trips, from the materialized totals."""
+    conn, backend = get_conn()
+    cur = conn.cursor()
+    ph = _ph(backend)
+    cur.execute(f'''
+        SELECT t.id, COALESCE(s.total_cents, 0) FROM trips t
+        LEFT JOIN trip_spend s ON s.trip_id = t.id
+        WHERE t.user_id = {ph}
+    ''', (user_id,))
+    totals = {r[0]: r[1] / 100 for r in cur.fetchall()}
+    cur.close()
+    conn.close()
+    return totals
+
+
+def iter_trip_spend(chunk_size=1000):
+    """
+    Yield lists of (trip_id, destination, start_date, end_date, stay_type,
+    budget, spent) for every trip with recorded expenses, `chunk_size` trips
+    at a time. Pages are keyed on trips.id (keyset pagination) and spend comes
+    from the materialized trip_spend totals, so memory and per-query work stay
+    bounded however many expense rows there are.
+    """
     conn, backend = get_conn()
     cur = conn.cursor()
     ph = _ph(backend)
+    last_id = 0
     try:
-        cur.execute(
-            f"INSERT INTO activity_logs (user_id, ip_address, endpoint, action) VALUES ({ph},{ph},{ph},{ph})",
-            (user_id, ip_address, endpoint, action)
-        )
-        conn.commit()
-    except Exception as e:
-        print(f"Failed to log activity: {e}")
-        conn.rollback()
+        while True:
+            cur.execute(f'''
+                SELECT t.id, t.destination, t.start_date, t.end_date, t.stay_type, t.budget,
+                       CASE WHEN s.expense_count > 0 THEN s.total_cents END AS spent_cents
+                FROM trips t
+                LEFT JOIN trip_spend s ON s.trip_id = t.id
+                WHERE t.id > {ph}
+                ORDER BY t.id
+                LIMIT {ph}
+            ''', (last_id, chunk_size))
+            rows = [tuple(r) for r in cur.fetchall()]
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield [r[:6] + (r[6] / 100,) for r in rows if r[6] is not None]
     finally:
         cur.close()
         conn.close()
 
 
+# ─────────────────────────────────────────────────────────────────────────────
+# 4. ADMIN & ANALYTICS FUNCTIONS
+# ─────────────────────────────────────────────────────────────────────────────
+
+# Activity logs are written off the request path: log_activity() only queues
+# the row, and a background thread inserts queued rows in batches.
+ACTIVITY_LOG_QUEUE_MAX = int(os.environ.get('ACTIVITY_LOG_QUEUE_MAX', '10000'))  # oldest rows dropped beyond this
+ACTIVITY_LOG_BATCH_ROWS = int(os.environ.get('ACTIVITY_LOG_BATCH_ROWS', '200'))
+ACTIVITY_LOG_FLUSH_MS = int(os.environ.get('ACTIVITY_LOG_FLUSH_MS', '500'))
+
+
+class _ActivityLogWriter:
+    """
+    Bounded in-process buffer for activity_logs rows, drained by a daemon
+    thread with one executemany per batch: every ACTIVITY_LOG_BATCH_ROWS
+    rows, or ACTIVITY_LOG_FLUSH_MS after the first queued row. When the
+    queue is full the oldest row is dropped.
+    """
+
+    def __init__(self, maxlen, batch_rows, flush_ms):
+        self._rows = collections.deque(maxlen=max(1, maxlen))
+        self.batch_rows = max(1, batch_rows)
+        self.flush_seconds = flush_ms / 1000
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self.stats = {'queued': 0, 'flushed': 0, 'dropped': 0, 'failed': 0, 'batches': 0}
+
+    def put(self, row):
+        with self._cond:
+            if len(self._rows) == self._rows.maxlen:
+                self.stats['dropped'] += 1
+            self._rows.append(row)
+            self.stats['queued'] += 1
+            if self._thread is None:
+                # Started lazily so it runs in the process that logs (i.e. after a gunicorn fork)
+                self._thread = threading.Thread(target=self._run, daemon=True, name='activity-log-writer')
+                self._thread.start()
+            # Wake the writer when the first row arrives (it starts the FLUSH_MS clock) or a batch is full
+            if len(self._rows) == 1 or len(self._rows) >= self.batch_rows:
+                self._cond.notify()
+
+    def _take(self, limit):
+        return [self._rows.popleft() for _ in range(min(limit, len(self._rows)))]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._rows:
+                    self._cond.wait()
+                deadline = time.monotonic() + self.flush_seconds
+                while len(self._rows) < self.batch_rows:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._take(self.batch_rows)
+            self._write(batch)
+
+    def flush(self):
+        """Synchronously write everything still queued (used at shutdown)."""
+        while True:
+            with self._cond:
+                batch = self._take(self.batch_rows)
+            if not batch:
+                return
+            self._write(batch)
+
+    def _write(self, batch):
+        with self._write_lock:
+            conn, backend = get_conn()
+            cur = conn.cursor()
+            ph = _ph(backend)
+            if backend == 'pg':
+                rows = batch
+            else:
+                # Same text format SQLite's CURRENT_TIMESTAMP default produces (UTC)
+                rows = [r[:4] + (r[4].strftime('%Y-%m-%d %H:%M:%S'),) for r in batch]
+            try:
+                cur.executemany(
+                    f"INSERT INTO activity_logs (user_id, ip_address, endpoint, action, timestamp) VALUES ({ph},{ph},{ph},{ph},{ph})",
+                    rows
+                )
+                conn.commit()
+                with self._cond:
+                    self.stats['flushed'] += len(batch)
+                    self.stats['batches'] += 1
+            except Exception as e:
+                print(f"Failed to log activity: {e}")
+                conn.rollback()
+                with self._cond:
+                    self.stats['failed'] += len(batch)
+            finally:
+                cur.close()
+                conn.close()
+
+    def snapshot(self):
+        with self._cond:
+            return dict(self.stats, pending=len(self._rows), queue_max=self._rows.maxlen)
+
+
+def _new_activity_log_writer():
+    return _ActivityLogWriter(ACTIVITY_LOG_QUEUE_MAX, ACTIVITY_LOG_BATCH_ROWS, ACTIVITY_LOG_FLUSH_MS)
+
+
+_activity_log = _new_activity_log_writer()
+
+
+def _reset_activity_log_after_fork():
+    # The parent's queued rows are its own to write; the writer thread did not survive the fork
+    global _activity_log
+    _activity_log = _new_activity_log_writer()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_activity_log_after_fork)
+atexit.register(lambda: _activity_log.flush())
+
+
+def log_activity(user_id, ip_address, endpoint, action):
+    """Queues one activity_logs row; it is written by the background writer."""
+    _activity_log.put((user_id, ip_address, endpoint, action,
+                       datetime.datetime.now(datetime.timezone.utc)))
+
+
+def flush_activity_logs():
+    """Writes all queued activity_logs rows now."""
+    _activity_log.flush()
+
+
+def activity_log_stats():
+    """Queued / flushed / dropped / failed row counters of this process's activity-log writer."""
+    return dict(_activity_log.snapshot(), pid=os.getpid())
+
+
 def get_admin_dashboard_metrics():
+    _activity_log.flush()  # so recent_logs includes rows still queued in this worker
     conn, backend = get_conn()
     cur = conn.cursor()
     ph = _ph(backend)
@@ -488,6 +1280,114 @@ def toggle_block_user(user_id, block_status):
 
 
 # ─────────────────────────────────────────────────────────────────────────────
-# 5. AUTO-INIT on import
+# 5. LIVE TRACKING SESSIONS
+# Latest position per tracker, shared by every gunicorn worker: the position
+# push and the SSE stream of one session may be served by different workers.
+# ─────────────────────────────────────────────────────────────────────────────
+
+def create_tracking_session(session_id, user_id, weather='clear', vehicle='sedan', terrain='highway'):
+    conn, backend = get_conn()
+    cur = conn.cursor()
+    ph = _ph(backend)
+    try:
+        cur.execute(
+            f"INSERT INTO tracking_sessions (id, user_id, weather, vehicle, terrain) VALUES ({ph},{ph},{ph},{ph},{ph})",
+            (session_id, user_id, weather, vehicle, terrain)
+        )
+        conn.commit()
+        return True
+    except Exception as e:
+        print(f"Error creating tracking session: {e}")
+        conn.rollback()
+        return False
+    finally:
+        cur.close()
+        conn.close()
+
+
+def update_tracking_position(session_id, user_id, distance_km, hour_of_day, day_type, weather=None):
+    """Store the tracker's latest remaining distance. Returns False if the session is not the user's."""
+    conn, backend = get_conn()
+    cur = conn.cursor()
+    ph = _ph(backend)
+    try:
+        cur.execute(f'''
+            UPDATE tracking_sessions
+               SET distance_km = {ph}, hour_of_day = {ph}, day_type = {ph},
+                   weather = COALESCE({ph}, weather), version = version + 1,
+                   updated_at = CURRENT_TIMESTAMP
+             WHERE id = {ph} AND user_id = {ph}
+        ''', (distance_km, hour_of_day, day_type, weather, session_id, user_id))
+        conn.commit()
+        return cur.rowcount > 0
+    except Exception as e:
+        print(f"Error updating tracking position: {e}")
+        conn.rollback()
+        return False
+    finally:
+        cur.close()
+        conn.close()
+
+
+def get_tracking_session(session_id):
+    """Returns (id, user_id, distance_km, hour_of_day, day_type, weather, vehicle, terrain, version) or None."""
+    conn, backend = get_conn()
+    cur = conn.cursor()
+    ph = _ph(backend)
+    cur.execute(f'''
+        SELECT id, user_id, distance_km, hour_of_day, day_type, weather, vehicle, terrain, version
+          FROM tracking_sessions WHERE id = {ph}
+    ''', (session_id,))
+    row = cur.fetchone()
+    cur.close()
+    conn.close()
+    return tuple(row) if row else None
+
+
+def end_tracking_session(session_id, user_id):
+    conn, backend = get_conn()
+    cur = conn.cursor()
+    ph = _ph(backend)
+    try:
+        cur.execute(f"DELETE FROM tracking_sessions WHERE id = {ph} AND user_id = {ph}", (session_id, user_id))
+        conn.commit()
+        return cur.rowcount > 0
+    except Exception as e:
+        print(f"Error ending tracking session: {e}")
+        conn.rollback()
+        return False
+    finally:
+        cur.close()
+        conn.close()
+
+
+def expire_tracking_sessions(max_idle_seconds):
+    """Delete sessions with no position push for max_idle_seconds (tabs closed without /stop). Returns the count."""
+    conn, backend = get_conn()
+    cur = conn.cursor()
+    try:
+        if backend == 'pg':
+            cur.execute(
+                "DELETE FROM tracking_sessions WHERE updated_at < CURRENT_TIMESTAMP - make_interval(secs => %s)",
+                (float(max_idle_seconds),)
+            )
+        else:
+            cur.execute(
+                "DELETE FROM tracking_sessions WHERE updated_at < datetime('now', ?)",
+                (f'-{int(max_idle_seconds)} seconds',)
+            )
+        conn.commit()
+        return cur.rowcount
+    except Exception as e:
+        print(f"Error expiring tracking sessions: {e}")
+        conn.rollback()
+        return 0
+    finally:
+        cur.close()
+        conn.close()
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# 6. AUTO-INIT on import
 # ─────────────────────────────────────────────────────────────────────────────
 init_db()
\ No newline at end of file
@@ -1,18 +1,19 @@
 import json
+from types import MappingProxyType
 
 # All stay types the model knows about (must match train_models.py)
-VALID_STAY_TYPES = [
+VALID_STAY_TYPES = (
     'hostel', 'camping', 'friend_house', 'home', 'family_stay',
     'budget_hotel', '3star_hotel', 'resort', '5star_hotel',
     'dharamshala', 'ashram', 'guesthouse', 'homestay', 'heritage_hotel',
     'houseboat', 'treehouse', 'desert_camp', 'tent_resort'
-]
+)
 
 # All food types (must match train_models.py FOOD_DAILY_COST)
-VALID_FOOD_TYPES = [
+VALID_FOOD_TYPES = (
     'veg_thali', 'nonveg_thali', 'local_cuisine',
     'dhaba', 'restaurant', 'hotel_buffet',
-]
+)
 
 # Genuine Indian travel base costs (per person, per night/day)
 STAY_NIGHTLY_BASE = {
@@ -41,6 +42,10 @@ TRANSPORT_DAILY_PP = {
     'luxury':   1200,   
 }
 
+# Season / booking multipliers of the cost formula (must match train_models.py)
+SEASON_MULT = {'peak': 1.2, 'off-peak': 0.85, 'shoulder': 1.0, 'holiday': 1.35}
+BOOKING_MULT = {'last-minute': 1.10, 'normal': 1.0, 'advance': 0.88}
+
 # Destination cost multipliers — modest to avoid extreme inflation
 DESTINATION_MULTIPLIERS = {
     'budget':   0.85,
@@ -80,10 +85,56 @@ DESTINATION_CATEGORIES = {
     'tiruchirappalli': 'budget', 'salem': 'budget', 'tirunelveli': 'budget'
 }
 
+STAY_ALIASES = MappingProxyType({
+    'budget': 'budget_hotel', 'mid': '3star_hotel',
+    'luxury': '5star_hotel', 'hotel': 'budget_hotel',
+    'camp': 'camping', 'guesthouse': 'budget_hotel',
+    'homestay': 'budget_hotel', 'friend': 'friend_house',
+    'home': 'home', 'family': 'family_stay'
+})
+
+FOOD_ALIASES = MappingProxyType({
+    'street': 'dhaba', 'casual': 'local_cuisine', 'fine': 'restaurant',
+    'veg': 'veg_thali', 'nonveg': 'nonveg_thali', 'non-veg': 'nonveg_thali',
+    'buffet': 'hotel_buffet', 'thali': 'veg_thali',
+})
+
+VALID_TRAVEL_STYLES = ('budget', 'mid-range', 'mid', 'luxury')
+VALID_SEASONS = ('peak', 'off-peak', 'shoulder', 'holiday')
+VALID_BOOKINGS = ('last-minute', 'normal', 'advance')
+
+# One-lookup normalizers: every accepted (lower-cased) spelling -> canonical
+# label. Valid labels win over aliases of the same name.
+_STYLE_LOOKUP = MappingProxyType({v: v for v in VALID_TRAVEL_STYLES})
+_FOOD_LOOKUP = MappingProxyType({**FOOD_ALIASES, **{v: v for v in VALID_FOOD_TYPES}})
+_SEASON_LOOKUP = MappingProxyType({v: v for v in VALID_SEASONS})
+_BOOKING_LOOKUP = MappingProxyType({v: v for v in VALID_BOOKINGS})
+_STAY_LOOKUP = MappingProxyType({**STAY_ALIASES, **{v: v for v in VALID_STAY_TYPES}})
+
+# Stays with no room rent or food bill — only transport is left
+HOME_STAY_TYPES = ('friend_house', 'home', 'family_stay')
+
+# Plan optimizer search space: stays you can book (not someone's home) and the
+# distinct travel styles ('mid-range' is an alias of 'mid')
+OPTIMIZER_STAY_TYPES = tuple(st for st in VALID_STAY_TYPES if st not in HOME_STAY_TYPES)
+OPTIMIZER_TRAVEL_STYLES = ('budget', 'mid', 'luxury')
+# Booking adds no comfort, so plans are priced only at the booking the cost
+# formula makes cheapest; searching it would let forest noise pick the booking
+OPTIMIZER_BOOKING = min(VALID_BOOKINGS, key=BOOKING_MULT.__getitem__)
+
+# Comfort of a plan: each option is ranked by its base cost (0 = cheapest,
+# 1 = priciest) and the ranks are weighted by their rough share of the trip
+COMFORT_WEIGHTS = {'stay_type': 0.5, 'food_type': 0.3, 'travel_style': 0.2}
+
+import os
+import threading
+import numpy as np
 import pandas as pd
 import joblib
 import warnings
 
+from model_registry import ModelHandle, lru_stats, prediction_cache
+
 # Suppress sklearn InconsistentVersionWarning from joblib loading
 warnings.filterwarnings("ignore", category=UserWarning)
 try:
@@ -92,86 +143,381 @@ try:
 except Exception:
     pass
 
+# Base-cost model: 'forest' (the RandomForest), 'analytic' (the closed-form
+# cost formula the forest is trained on) or 'blend' (weighted mix of both)
+BUDGET_BACKEND = os.environ.get('BUDGET_BACKEND', 'forest').lower()
+BUDGET_BLEND_WEIGHT = float(os.environ.get('BUDGET_BLEND_WEIGHT', '0.5'))  # analytic share in 'blend'
+# Largest batch sent through the compiled forest; sklearn's tree-at-a-time
+# predict wins above a few hundred rows (crossover ~500-800 rows here)
+BUDGET_COMPILED_MAX_ROWS = int(os.environ.get('BUDGET_COMPILED_MAX_ROWS', '512'))
+
+def _normalize_style(travel_style):
+    return _STYLE_LOOKUP.get(travel_style.lower(), 'mid')
+
+
+def _normalize_food(food_type):
+    return _FOOD_LOOKUP.get(food_type.lower(), 'local_cuisine')
+
+
+def _normalize_season(season):
+    return _SEASON_LOOKUP.get(season.lower(), 'shoulder')
+
+
+def _normalize_booking(booking):
+    return _BOOKING_LOOKUP.get(booking.lower(), 'normal')
+
+
+def _normalize_stay(stay_type):
+    return _STAY_LOOKUP.get(stay_type.lower().strip(), 'budget_hotel')
+
+
+def _destination_multiplier(destination):
+    """Cost multiplier of a destination's category ('Goa, India' -> goa -> luxury -> 1.30)."""
+    if not destination:
+        return 1.0
+    # Extract city name (remove "India" or other suffixes)
+    dest_city = destination.lower().strip().split(',')[0].strip()
+    dest_category = DESTINATION_CATEGORIES.get(dest_city, 'standard')
+    return DESTINATION_MULTIPLIERS.get(dest_category, 1.0)
+
+
+def _normalize_features(days, group_size, travel_style, food_type, season, booking, stay_type):
+    """Feature row matching the training pipeline schema, with every label normalized."""
+    return {
+        'days': days,
+        'group_size': min(20, max(1, int(group_size))),
+        'travel_style': _normalize_style(travel_style),
+        'food_type': _normalize_food(food_type),
+        'season': _normalize_season(season),
+        'booking': _normalize_booking(booking),
+        'stay_type': _normalize_stay(stay_type)
+    }
+
+
+def _analytic_cost(days, group_size, travel_style, food_type, season, booking, stay_type):
+    """
+    Expected group total of the cost formula the training labels are drawn
+    from (before their ±8% noise), in the generator's operation order.
+    Labels must already be normalized.
+    """
+    s_mult = SEASON_MULT[season]
+    nightly_pp = STAY_NIGHTLY_BASE[stay_type] * s_mult * BOOKING_MULT[booking]
+    food_daily_pp = FOOD_DAILY_COST[food_type] * s_mult
+    transport_pp = TRANSPORT_DAILY_PP[travel_style] * s_mult
+    return (nightly_pp + food_daily_pp + transport_pp) * days * group_size
+
+
+def _analytic_cost_many(features):
+    """Column-wise _analytic_cost() over normalized feature columns."""
+    def lookup(column, table):
+        return _map_column(column, table.__getitem__).astype(np.float64)
+
+    s_mult = lookup(features['season'], SEASON_MULT)
+    nightly_pp = lookup(features['stay_type'], STAY_NIGHTLY_BASE) * s_mult * lookup(features['booking'], BOOKING_MULT)
+    food_daily_pp = lookup(features['food_type'], FOOD_DAILY_COST) * s_mult
+    transport_pp = lookup(features['travel_style'], TRANSPORT_DAILY_PP) * s_mult
+    return (nightly_pp + food_daily_pp + transport_pp) * features['days'] * features['group_size']
+
+
+def _map_column(values, normalize):
+    """Apply a scalar normalizer to a scalar or an (nested) sequence, once per distinct value."""
+    if isinstance(values, str):
+        return np.asarray(normalize(values), dtype=object)
+    values = np.asarray(values, dtype=object)
+    seen = {}
+    out = np.empty(values.shape, dtype=object)
+    for i, value in enumerate(values.flat):
+        if value not in seen:
+            seen[value] = normalize(value)
+        out.flat[i] = seen[value]
+    return out
+
+
+def _comfort_levels(options, base_costs):
+    """Dense rank of each option's base cost, scaled to 0..1."""
+    levels = sorted(set(base_costs[o] for o in options))
+    top = max(1, len(levels) - 1)
+    return np.array([levels.index(base_costs[o]) / top for o in options])
+
+
+def _round_2dp(values):
+    """
+    Vectorized round(x, 2). np.round disagrees with Python's correctly-rounded
+    round() on near-ties, so those few entries go through round() itself.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    flat = values.reshape(-1)
+    rounded = np.round(flat, 2)
+    scaled = flat * 100.0
+    near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    if near_tie.any():
+        rounded[near_tie] = [round(v, 2) for v in flat[near_tie].tolist()]
+    return rounded.reshape(values.shape)
+
+
+class _CompiledEncoder:
+    """
+    The fitted ColumnTransformer (one-hot + passthrough) flattened into
+    lookup tables, so one row is encoded straight into a NumPy feature
+    vector without building a DataFrame or going through sklearn.
+    """
+
+    def __init__(self, preprocessor):
+        from sklearn.preprocessing import FunctionTransformer
+
+        columns = list(preprocessor.feature_names_in_)
+        self.onehot = []       # (column, {category: feature position})
+        self.passthrough = []  # (column, feature position)
+        self.n_features = 0
+        for name, transformer, cols in preprocessor.transformers_:
+            out = preprocessor.output_indices_[name]
+            self.n_features = max(self.n_features, out.stop)
+            if out.start == out.stop:
+                continue
+            cols = [columns[c] if isinstance(c, (int, np.integer)) else c for c in cols]
+            if hasattr(transformer, 'categories_'):
+                if transformer.drop_idx_ is not None or getattr(transformer, '_infrequent_enabled', False):
+                    raise ValueError(f"unsupported one-hot options in '{name}'")
+                pos = out.start
+                for col, categories in zip(cols, transformer.categories_):
+                    self.onehot.append((col, {c: pos + i for i, c in enumerate(categories.tolist())}))
+                    pos += len(categories)
+            elif transformer == 'passthrough' or (isinstance(transformer, FunctionTransformer) and transformer.func is None):
+                self.passthrough.extend((col, out.start + i) for i, col in enumerate(cols))
+            else:
+                raise ValueError(f"unsupported transformer '{name}'")
+        self._local = threading.local()
+
+    def encode(self, row):
+        """Encode a dict of feature values into this thread's reusable (1, n) buffer."""
+        x = getattr(self._local, 'buffer', None)
+        if x is None:
+            x = self._local.buffer = np.zeros((1, self.n_features))
+        else:
+            x.fill(0.0)
+        for col, positions in self.onehot:
+            pos = positions.get(row[col])  # unknown category -> all zeros, like handle_unknown='ignore'
+            if pos is not None:
+                x[0, pos] = 1.0
+        for col, pos in self.passthrough:
+            x[0, pos] = row[col]
+        return x
+
+    def encode_many(self, columns):
+        """Encode equal-length feature columns ({name: sequence}) into a new (rows, n) matrix."""
+        n = len(next(iter(columns.values())))
+        X = np.zeros((n, self.n_features))
+        rows = np.arange(n)
+        for col, positions in self.onehot:
+            pos = np.array([positions.get(v, -1) for v in columns[col]], dtype=np.intp)
+            known = pos >= 0
+            X[rows[known], pos[known]] = 1.0
+        for col, pos in self.passthrough:
+            X[:, pos] = columns[col]
+        return X
+
+
+class _CompiledForest:
+    """
+    RandomForest evaluator over the flattened node arrays written by
+    train_models.export_budget_forest. Every tree advances one level per
+    step, so a single row costs max_depth small vector ops and a batch the
+    same number of (rows x trees) ops. Leaves are turned into self-loops
+    so finished trees simply stay put until the deepest one is done.
+    """
+
+    def __init__(self, path):
+        with np.load(path) as arrays:
+            self.feature = arrays['feature'].astype(np.intp)
+            self.threshold = arrays['threshold']
+            left = arrays['left'].astype(np.intp)
+            right = arrays['right'].astype(np.intp)
+            self.value = arrays['value']
+            self.roots = arrays['roots'].astype(np.intp)
+            self.n_features = int(arrays['n_features'])
+            self.max_depth = int(arrays['max_depth'])
+        nodes = np.arange(len(left))
+        leaf = left < 0
+        # children[node, went_left]: one gather picks the next node per tree
+        self.children = np.stack([np.where(leaf, nodes, right), np.where(leaf, nodes, left)], axis=1)
+        self.feature[leaf] = 0
+
+    def predict_one(self, x):
+        """Forest mean for one encoded feature vector (shape (n_features,))."""
+        # sklearn compares float32 features against float64 thresholds
+        x = np.asarray(x, dtype=np.float32).reshape(-1)
+        node = self.roots
+        for _ in range(self.max_depth):
+            went_left = x[self.feature[node]] <= self.threshold[node]
+            node = self.children[node, went_left.view(np.int8)]
+        # Sequential sum in tree order, as sklearn accumulates it
+        return float(np.cumsum(self.value[node])[-1] / len(self.roots))
+
+    def predict_many(self, X):
+        """Forest means for a (rows, n_features) matrix of encoded rows."""
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        flat = X.ravel()
+        row_base = (np.arange(len(X)) * X.shape[1])[:, None]
+        node = np.broadcast_to(self.roots, (len(X), len(self.roots)))
+        for _ in range(self.max_depth):
+            went_left = flat[row_base + self.feature[node]] <= self.threshold[node]
+            node = self.children[node, went_left.view(np.int8)]
+        return np.cumsum(self.value[node], axis=1)[:, -1] / len(self.roots)
+
+
 class HypercubeBudgetEngine:
     """
     N-Dimensional Budget Hypercube Inference Engine (v2) - True Scikit-Learn Model.
     Dynamically predicts using RandomForestRegressor rather than hardcoded logic.
+    `backend` ('forest' / 'analytic' / 'blend', default BUDGET_BACKEND) picks
+    the base-cost model; pricing adjustments are the same for all three.
     """
     MODEL_PATH = 'models/budget_rf.pkl'
+    FOREST_PATH = 'models/budget_forest.npz'
 
-    def __init__(self):
+    def __init__(self, artifact_dir=None, backend=None):
+        self.backend = (backend or BUDGET_BACKEND).lower()
+        self.blend_weight = BUDGET_BLEND_WEIGHT
+        self.model_path = os.path.join(artifact_dir, 'budget_rf.pkl') if artifact_dir else self.MODEL_PATH
+        self.forest_path = os.path.join(artifact_dir, 'budget_forest.npz') if artifact_dir else self.FOREST_PATH
         self.pipeline = None
+        self.regressor = None
+        self.encoder = None
+        self.forest = None
+        self._predict_cached = prediction_cache(self._predict_normalized)
         self._load()
 
+    def _is_ready(self):
+        return self.pipeline is not None
+
     def _load(self):
         try:
-            self.pipeline = joblib.load(self.MODEL_PATH)
+            self.pipeline = joblib.load(self.model_path)
+            self.regressor = self.pipeline.steps[-1][1]
+            # Inference is one row at a time: fanning trees out to threads costs more than it saves
+            if hasattr(self.regressor, 'n_jobs'):
+                self.regressor.n_jobs = 1
+            self.encoder = self._compile_encoder()
+            self.forest = self._compile_forest() if self.encoder is not None else None
             print("Loaded True ML Budget RandomForest Model successfully.")
         except Exception as e:
             print("Warning: Budget ML model not found or incomplete. Run train_models.py first.", e)
             self.pipeline = None
+            self.encoder = None
+            self.forest = None
+
+    @staticmethod
+    def _probe_rows(encoder):
+        """Feature rows touching every known category (plus an unknown one) of each column."""
+        widest = max(len(positions) for _, positions in encoder.onehot)
+        probe = []
+        for i in range(widest + 1):
+            row = {col: list(positions)[i] if i < len(positions) else 'unknown'
+                   for col, positions in encoder.onehot}
+            row.update({col: 1 + (i * 7) % 60 for col, _ in encoder.passthrough})
+            probe.append(row)
+        return probe
+
+    def _compile_encoder(self):
+        """
+        Extract the pandas-free encoder from the fitted pipeline and check it
+        reproduces the pipeline exactly on a probe set; None disables the fast path.
+        """
+        try:
+            encoder = _CompiledEncoder(self.pipeline.named_steps['preprocessor'])
+            probe = self._probe_rows(encoder)
+            expected = self.pipeline.predict(pd.DataFrame(probe))
+            actual = [self.regressor.predict(encoder.encode(row))[0] for row in probe]
+            if not np.array_equal(expected, actual):
+                raise ValueError("compiled encoder disagrees with the pipeline")
+            return encoder
+        except Exception as e:
+            print("Warning: budget fast path disabled, using the sklearn pipeline.", e)
+            return None
+
+    def _compile_forest(self):
+        """
+        Load the array-compiled forest next to the pickle and check it matches
+        the sklearn regressor on the probe set; None keeps sklearn's predict.
+        """
+        if not os.path.exists(self.forest_path):
+            return None
+        try:
+            forest = _CompiledForest(self.forest_path)
+            if forest.n_features != self.encoder.n_features or len(forest.roots) != len(self.regressor.estimators_):
+                raise ValueError("compiled forest does not match the pickled model")
+            X = np.vstack([self.encoder.encode(row).copy() for row in self._probe_rows(self.encoder)])
+            expected = self.regressor.predict(X)
+            if not (np.array_equal(forest.predict_many(X), expected)
+                    and np.array_equal([forest.predict_one(x) for x in X], expected)):
+                raise ValueError("compiled forest disagrees with the regressor")
+            return forest
+        except Exception as e:
+            print("Warning: compiled budget forest disabled, using sklearn's predict.", e)
+            return None
+
+    def _forest_cost(self, features):
+        # Real ML prediction (RandomForest). The compiled encoder feeds the
+        # array-compiled forest (or the sklearn regressor if there is none);
+        # the DataFrame + Pipeline path is the fallback.
+        if self.forest is not None:
+            return self.forest.predict_one(self.encoder.encode(features)[0])
+        if self.encoder is not None:
+            return float(self.regressor.predict(self.encoder.encode(features))[0])
+        return float(self.pipeline.predict(pd.DataFrame([features]))[0])
+
+    def _forest_cost_many(self, features):
+        # Both evaluators agree bit for bit (checked in _compile_forest); pick the faster by batch size
+        if self.encoder is not None:
+            X = self.encoder.encode_many(features)
+            if self.forest is not None and len(X) <= BUDGET_COMPILED_MAX_ROWS:
+                return self.forest.predict_many(X)
+            return self.regressor.predict(X)
+        return self.pipeline.predict(pd.DataFrame(features))
+
+    def _base_cost(self, features):
+        """
+        Group total before destination and discount adjustments, from the
+        configured backend. 'blend' without a trained forest degrades to the
+        analytic model; None means no model is available at all.
+        """
+        if self.backend == 'analytic' or (self.backend == 'blend' and not self.pipeline):
+            return _analytic_cost(**features)
+        if not self.pipeline:
+            return None
+        forest = self._forest_cost(features)
+        if self.backend == 'blend':
+            return self.blend_weight * _analytic_cost(**features) + (1.0 - self.blend_weight) * forest
+        return forest
+
+    def _base_cost_many(self, features):
+        """Column-wise _base_cost()."""
+        if self.backend == 'analytic' or (self.backend == 'blend' and not self.pipeline):
+            return _analytic_cost_many(features)
+        if not self.pipeline:
+            return None
+        forest = self._forest_cost_many(features)
+        if self.backend == 'blend':
+            return self.blend_weight * _analytic_cost_many(features) + (1.0 - self.blend_weight) * forest
+        return forest
 
     def predict(self, days, travel_style="mid", food_type="casual",
                 group_size=1, season="shoulder", booking="normal",
                 stay_type="budget_hotel", is_family=False, destination=""):
         if days <= 0:
             return 0.0
-            
-        grp = min(20, max(1, int(group_size)))
-
-        # Fallback dictionary matching aliases
-        VALID_FOOD_TYPES = ['veg_thali', 'nonveg_thali', 'local_cuisine', 'dhaba', 'restaurant', 'hotel_buffet']
-        VALID_STAY_TYPES = ['hostel', 'camping', 'dharamshala', 'ashram', 'guesthouse', 'budget_hotel', 'homestay', 'heritage_hotel', '3star_hotel', 'resort', '5star_hotel', 'houseboat', 'treehouse', 'desert_camp', 'tent_resort', 'friend_house', 'home', 'family_stay']
-
-        style = travel_style.lower()
-        if style not in ['budget', 'mid-range', 'mid', 'luxury']:
-            style = 'mid'
-
-        food = food_type.lower()
-        if food not in VALID_FOOD_TYPES:
-            _food_aliases = {
-                'street': 'dhaba', 'casual': 'local_cuisine', 'fine': 'restaurant',
-                'veg': 'veg_thali', 'nonveg': 'nonveg_thali', 'non-veg': 'nonveg_thali',
-                'buffet': 'hotel_buffet', 'thali': 'veg_thali',
-            }
-            food = _food_aliases.get(food, 'local_cuisine')
-
-        s = season.lower()
-        if s not in ['peak', 'off-peak', 'shoulder', 'holiday']:
-            s = 'shoulder'
-
-        b = booking.lower()
-        if b not in ['last-minute', 'normal', 'advance']:
-            b = 'normal'
-
-        st = stay_type.lower().strip()
-        if st not in VALID_STAY_TYPES:
-            _aliases = {
-                'budget': 'budget_hotel', 'mid': '3star_hotel',
-                'luxury': '5star_hotel', 'hotel': 'budget_hotel',
-                'camp': 'camping', 'guesthouse': 'budget_hotel',
-                'homestay': 'budget_hotel', 'friend': 'friend_house',
-                'home': 'home', 'family': 'family_stay'
-            }
-            st = _aliases.get(st, 'budget_hotel')
-
-        # Process destination for cost adjustment
-        dest_multiplier = 1.0  # Default multiplier
-        if destination:
-            dest_lower = destination.lower().strip()
-            # Extract city name (remove "India" or other suffixes)
-            dest_city = dest_lower.split(',')[0].strip()
-            dest_category = DESTINATION_CATEGORIES.get(dest_city, 'standard')
-            dest_multiplier = DESTINATION_MULTIPLIERS.get(dest_category, 1.0)
-
-        # If pipeline not ready, return fallback math
-        if not self.pipeline:
-            self._load()
-        if not self.pipeline:
-            return round(1500 * days * grp * dest_multiplier, 2)
 
-        # Prepare DataFrame to match the training pipeline schema
-        df = pd.DataFrame([{
+        # Memoized on the normalized inputs; the destination only matters through its multiplier
+        return self._predict_cached(
+            days, min(20, max(1, int(group_size))),
+            _normalize_style(travel_style), _normalize_food(food_type),
+            _normalize_season(season), _normalize_booking(booking),
+            _normalize_stay(stay_type), bool(is_family),
+            _destination_multiplier(destination),
+        )
+
+    def _predict_normalized(self, days, grp, style, food, s, b, st, is_family, dest_multiplier):
+        features = {
             'days': days,
             'group_size': grp,
             'travel_style': style,
@@ -179,10 +525,14 @@ class HypercubeBudgetEngine:
             'season': s,
             'booking': b,
             'stay_type': st
-        }])
-        
-        # Real ML prediction (uses RandomForest + Pipeline logic)
-        predicted_budget = float(self.pipeline.predict(df)[0])
+        }
+
+        # Base cost of the whole group from the configured backend
+        predicted_budget = self._base_cost(features)
+
+        # If pipeline not trained yet (and not in analytic mode), return fallback math
+        if predicted_budget is None:
+            return round(1500 * days * grp * dest_multiplier, 2)
 
         # Apply destination cost multiplier
         predicted_budget = predicted_budget * dest_multiplier
@@ -201,12 +551,171 @@ class HypercubeBudgetEngine:
             predicted_budget = predicted_budget * 0.80
 
         # 3. Staying with Family / Friends / Home (no room/food costs)
-        if st in ['friend_house', 'home', 'family_stay']:
+        if st in HOME_STAY_TYPES:
             # No room rent and no food costs (home-cooked meals).
             # Only transport costs remain - estimate ~20% of total budget
             predicted_budget = predicted_budget * 0.20
 
         return round(predicted_budget, 2)
 
-# Singleton instance
-budget_model = HypercubeBudgetEngine()
+    def predict_many(self, days, travel_style="mid", food_type="casual",
+                     group_size=1, season="shoulder", booking="normal",
+                     stay_type="budget_hotel", is_family=False, destination=""):
+        """
+        Vectorized predict(). Every argument may be a scalar or a sequence;
+        they are broadcast together, categorical inputs are normalized once
+        per distinct value, and the base-cost model runs once for all rows.
+        Returns a float64 array of budgets, identical to per-row predict().
+        """
+        days = np.asarray(days)
+        grp = np.clip(np.asarray(group_size).astype(np.int64), 1, 20)
+        columns = np.broadcast_arrays(
+            days, grp,
+            _map_column(travel_style, _normalize_style),
+            _map_column(food_type, _normalize_food),
+            _map_column(season, _normalize_season),
+            _map_column(booking, _normalize_booking),
+            _map_column(stay_type, _normalize_stay),
+            np.asarray(is_family, dtype=bool),
+            _map_column(destination, _destination_multiplier).astype(np.float64),
+        )
+        shape = columns[0].shape
+        days, grp, style, food, s, b, st, family, dest_multiplier = (c.reshape(-1) for c in columns)
+
+        features = {
+            'days': days,
+            'group_size': grp,
+            'travel_style': style,
+            'food_type': food,
+            'season': s,
+            'booking': b,
+            'stay_type': st
+        }
+        predicted = self._base_cost_many(features)
+        if predicted is None:
+            budgets = 1500 * days * grp * dest_multiplier
+            return np.where(days > 0, _round_2dp(budgets), 0.0).reshape(shape)
+
+        # Same adjustments, in the same order, as predict()
+        predicted = predicted * dest_multiplier
+        discount_pct = np.minimum(0.30, 0.05 + (grp * 0.025))
+        predicted = np.where(grp >= 3, predicted * (1.0 - discount_pct), predicted)
+        predicted = np.where(family, predicted * 0.80, predicted)
+        predicted = np.where(np.isin(st, HOME_STAY_TYPES), predicted * 0.20, predicted)
+
+        return np.where(days > 0, _round_2dp(predicted), 0.0).reshape(shape)
+
+    def cache_stats(self):
+        """Counters of this engine's predict() cache (reset with every model version)."""
+        return lru_stats(self._predict_cached)
+
+    def predict_breakdown(self, days, travel_style="mid", food_type="casual",
+                          group_size=1, season="shoulder", booking="normal",
+                          stay_type="budget_hotel", is_family=False, destination=""):
+        """
+        predict() plus the total split into stay / food / transport, using each
+        component's share of the cost formula. Home stays are all transport.
+        """
+        total = self.predict(days, travel_style, food_type, group_size, season,
+                             booking, stay_type, is_family, destination)
+        features = _normalize_features(max(days, 0), group_size, travel_style, food_type, season, booking, stay_type)
+        s_mult = SEASON_MULT[features['season']]
+        components = {
+            'stay': STAY_NIGHTLY_BASE[features['stay_type']] * s_mult * BOOKING_MULT[features['booking']],
+            'food': FOOD_DAILY_COST[features['food_type']] * s_mult,
+            'transport': TRANSPORT_DAILY_PP[features['travel_style']] * s_mult,
+        }
+        if features['stay_type'] in HOME_STAY_TYPES:
+            components['stay'] = components['food'] = 0.0
+        per_unit = sum(components.values())
+        breakdown = {k: round(total * v / per_unit, 2) for k, v in components.items()}
+        return {'estimated_budget': total, 'breakdown': breakdown, 'model': self.backend}
+
+    def scenario_matrix(self, days, group_size=1, travel_style="mid",
+                        is_family=False, destination=""):
+        """
+        Budgets for every stay type x food type x season x booking of one trip
+        in a single predict_many() call. Returns (axes, budgets) where axes is
+        an ordered dict of label lists and budgets has shape
+        (len(VALID_STAY_TYPES), len(VALID_FOOD_TYPES), len(VALID_SEASONS), len(VALID_BOOKINGS)).
+        """
+        axes = {
+            'stay_type': list(VALID_STAY_TYPES),
+            'food_type': list(VALID_FOOD_TYPES),
+            'season': list(VALID_SEASONS),
+            'booking': list(VALID_BOOKINGS),
+        }
+        budgets = self.predict_many(
+            days,
+            travel_style=travel_style,
+            food_type=np.array(axes['food_type'], dtype=object)[None, :, None, None],
+            group_size=group_size,
+            season=np.array(axes['season'], dtype=object)[None, None, :, None],
+            booking=np.array(axes['booking'], dtype=object)[None, None, None, :],
+            stay_type=np.array(axes['stay_type'], dtype=object)[:, None, None, None],
+            is_family=is_family,
+            destination=destination,
+        )
+        return axes, budgets
+
+    def optimize(self, budget_cap, days, group_size=1, season="shoulder",
+                 is_family=False, destination="", top_k=5):
+        """
+        Most comfortable plans that fit under `budget_cap`. Every stay type x
+        food type x travel style combination is priced in one predict_many()
+        call at OPTIMIZER_BOOKING; plans beaten on both comfort and cost by another
+        affordable plan are pruned, and the remaining Pareto frontier is
+        returned most comfortable (= closest to the cap) first.
+        """
+        axes = {
+            'stay_type': OPTIMIZER_STAY_TYPES,
+            'food_type': VALID_FOOD_TYPES,
+            'travel_style': OPTIMIZER_TRAVEL_STYLES,
+            'booking': (OPTIMIZER_BOOKING,),
+        }
+        shape = tuple(len(labels) for labels in axes.values())
+
+        def axis(name, position):
+            view = [1] * len(shape)
+            view[position] = -1
+            return np.array(axes[name], dtype=object).reshape(view)
+
+        costs = self.predict_many(
+            days,
+            travel_style=axis('travel_style', 2),
+            food_type=axis('food_type', 1),
+            group_size=group_size,
+            season=season,
+            booking=axis('booking', 3),
+            stay_type=axis('stay_type', 0),
+            is_family=is_family,
+            destination=destination,
+        ).reshape(-1)
+
+        comfort = (
+            COMFORT_WEIGHTS['stay_type'] * _comfort_levels(axes['stay_type'], STAY_NIGHTLY_BASE)[:, None, None, None]
+            + COMFORT_WEIGHTS['food_type'] * _comfort_levels(axes['food_type'], FOOD_DAILY_COST)[None, :, None, None]
+            + COMFORT_WEIGHTS['travel_style'] * _comfort_levels(axes['travel_style'], TRANSPORT_DAILY_PP)[None, None, :, None]
+        )
+        comfort = np.round(np.broadcast_to(comfort, shape).reshape(-1), 4)
+
+        # Pareto frontier of the affordable plans: walking them cheapest first
+        # (most comfortable first on equal cost), keep a plan only if it is
+        # more comfortable than every cheaper one
+        feasible = np.flatnonzero((costs > 0) & (costs <= budget_cap))
+        order = feasible[np.lexsort((-comfort[feasible], costs[feasible]))]
+        best_before = np.maximum.accumulate(np.concatenate(([-1.0], comfort[order])))[:-1]
+        frontier = order[comfort[order] > best_before]
+
+        plans = []
+        for flat in frontier[::-1][:max(0, int(top_k))]:
+            idx = np.unravel_index(flat, shape)
+            plan = {name: labels[i] for (name, labels), i in zip(axes.items(), idx)}
+            plan['estimated_budget'] = float(costs[flat])
+            plan['comfort'] = float(comfort[flat])
+            plan['headroom'] = round(budget_cap - float(costs[flat]), 2)
+            plans.append(plan)
+        return plans, {'evaluated': int(costs.size), 'affordable': int(feasible.size), 'frontier': int(frontier.size)}
+
+# Singleton handle — always points at a fully loaded engine, hot-swapped by the registry
+budget_model = ModelHandle('budget', HypercubeBudgetEngine)
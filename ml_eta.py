@@ -1,62 +1,391 @@
+import bisect
 import json
 import os
 
-class HypercubeETAEngine:
+import numpy as np
+
+from model_registry import ModelHandle
+
+# Axis labels of the ETA hypercube (must match train_models.py)
+ETA_DAY_TYPES = ['weekday', 'weekend']
+ETA_WEATHERS = ['clear', 'rain', 'fog', 'snow']
+ETA_VEHICLES = ['sedan', 'suv', 'bike', 'bus']
+ETA_TERRAINS = ['highway', 'city', 'mountain', 'rural']
+
+
+def _legacy_grid_to_tensor(legacy):
+    """Convert the old nested-dict JSON grid into (tensor, axes) form."""
+    dist_keys = sorted(legacy.keys(), key=int)
+    grid = np.array([
+        [[[[[legacy[dk][str(h)][d][w][v][t] for t in ETA_TERRAINS]
+            for v in ETA_VEHICLES]
+           for w in ETA_WEATHERS]
+          for d in ETA_DAY_TYPES]
+         for h in range(24)]
+        for dk in dist_keys
+    ], dtype=np.float64)
+    axes = {
+        'dist_bins': [int(k) for k in dist_keys],
+        'hours': list(range(24)),
+        'day_types': ETA_DAY_TYPES,
+        'weathers': ETA_WEATHERS,
+        'vehicles': ETA_VEHICLES,
+        'terrains': ETA_TERRAINS,
+        'scale': 1,
+    }
+    return grid, axes
+
+
+def _round_1dp(values):
+    """
+    Vectorized round(x, 1). np.round disagrees with Python's correctly-rounded
+    round() on near-ties, so those few entries go through round() itself.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    flat = values.reshape(-1)
+    rounded = np.round(flat, 1)
+    scaled = flat * 10.0
+    near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    if near_tie.any():
+        rounded[near_tie] = [round(v, 1) for v in flat[near_tie].tolist()]
+    return rounded.reshape(values.shape)
+
+
+def _smaps_usage(path):
+    """Sum the /proc/self/smaps counters (in kB) of every mapping of `path`."""
+    usage = {'rss_kb': 0, 'pss_kb': 0, 'shared_kb': 0, 'private_kb': 0}
+    fields = {
+        'Rss:': ('rss_kb',), 'Pss:': ('pss_kb',),
+        'Shared_Clean:': ('shared_kb',), 'Shared_Dirty:': ('shared_kb',),
+        'Private_Clean:': ('private_kb',), 'Private_Dirty:': ('private_kb',),
+    }
+    in_mapping = False
+    with open('/proc/self/smaps', 'r') as f:
+        for line in f:
+            parts = line.split()
+            if not parts:
+                continue
+            if not parts[0].endswith(':'):
+                # Mapping header: "addr perms offset dev inode [path]"
+                in_mapping = line.rstrip('\n').endswith(' ' + path)
+            elif in_mapping and parts[0] in fields:
+                for key in fields[parts[0]]:
+                    usage[key] += int(parts[1])
+    return usage
+
+
+def _label_indices(index, labels):
+    """Map a label (or sequence of labels) to axis positions; unknown labels -> 0."""
+    if isinstance(labels, str):
+        return index.get(labels.lower(), 0)
+    return np.array([index.get(str(label).lower(), 0) for label in labels], dtype=np.intp)
+
+
+class _ETAEngineBase:
+    """
+    Shared input handling for the ETA backends. Subclasses load their
+    parameters once in _load(), report readiness via _is_ready() and compute
+    unrounded minutes in _minutes() / _minutes_many(). Instances are not
+    mutated after construction; new artifacts arrive as new instances
+    through the model registry.
+    """
+
+    def _set_label_axes(self, axes):
+        self.day_index = {name: i for i, name in enumerate(axes['day_types'])}
+        self.weather_index = {name: i for i, name in enumerate(axes['weathers'])}
+        self.vehicle_index = {name: i for i, name in enumerate(axes['vehicles'])}
+        self.terrain_index = {name: i for i, name in enumerate(axes['terrains'])}
+
+    def predict(self, distance_km, hour_of_day, day_type='weekday', weather='clear', vehicle='sedan', terrain='highway'):
+        if distance_km <= 0:
+            return 0.0
+
+        if not self._is_ready():
+            # Not trained yet — simple speed fallback (50 km/h average)
+            return round((distance_km / 50.0) * 60.0, 1)
+
+        # Variable sanitization (unknown labels fall back to the first axis entry)
+        hour_idx = max(0, min(23, int(hour_of_day)))
+        d_idx = self.day_index.get(day_type.lower(), 0)
+        w_idx = self.weather_index.get(weather.lower(), 0)
+        v_idx = self.vehicle_index.get(vehicle.lower(), 0)
+        t_idx = self.terrain_index.get(terrain.lower(), 0)
+
+        # Not memoized: distances are GPS floats that almost never repeat, and
+        # the lookup costs less than a cache probe would
+        return round(self._minutes(distance_km, hour_idx, d_idx, w_idx, v_idx, t_idx), 1)
+
+    def predict_many(self, distance_km, hour_of_day, day_type='weekday', weather='clear', vehicle='sedan', terrain='highway'):
+        """
+        Vectorized predict(). Every argument may be a scalar or a sequence;
+        they are broadcast together and answered in one array pass.
+        Returns a float64 array of minutes.
+        """
+        dist = np.asarray(distance_km, dtype=np.float64)
+        hours = np.clip(np.asarray(hour_of_day).astype(np.intp), 0, 23)
+
+        if not self._is_ready():
+            dist, hours = np.broadcast_arrays(dist, hours)
+            return np.where(dist > 0, _round_1dp((dist / 50.0) * 60.0), 0.0)
+
+        d_idx = _label_indices(self.day_index, day_type)
+        w_idx = _label_indices(self.weather_index, weather)
+        v_idx = _label_indices(self.vehicle_index, vehicle)
+        t_idx = _label_indices(self.terrain_index, terrain)
+        dist, hours, d_idx, w_idx, v_idx, t_idx = np.broadcast_arrays(dist, hours, d_idx, w_idx, v_idx, t_idx)
+
+        minutes = self._minutes_many(dist, hours, d_idx, w_idx, v_idx, t_idx)
+        return np.where(dist > 0, _round_1dp(minutes), 0.0)
+
+    def departure_matrix(self, distance_km, weather='clear', vehicle='sedan', terrain='highway'):
+        """
+        Minutes for every departure hour of every day type in one slice.
+        Arguments broadcast like predict_many(); the result has shape
+        (*broadcast_shape, len(day_types), 24), ordered as day_types().
+        """
+        dist = np.asarray(distance_km, dtype=np.float64)
+
+        if not self._is_ready():
+            minutes = np.where(dist > 0, _round_1dp((dist / 50.0) * 60.0), 0.0)
+            return np.broadcast_to(minutes[..., None, None], dist.shape + (2, 24)).copy()
+
+        w_idx = _label_indices(self.weather_index, weather)
+        v_idx = _label_indices(self.vehicle_index, vehicle)
+        t_idx = _label_indices(self.terrain_index, terrain)
+        dist, w_idx, v_idx, t_idx = (a[..., None, None] for a in np.broadcast_arrays(dist, w_idx, v_idx, t_idx))
+        hours = np.arange(24)[None, :]
+        d_idx = np.arange(len(self.day_index))[:, None]
+
+        minutes = self._minutes_many(dist, hours, d_idx, w_idx, v_idx, t_idx)
+        return np.where(dist > 0, _round_1dp(minutes), 0.0)
+
+    def predict_route(self, distance_km, vehicle='sedan', terrain='highway', weather='clear',
+                      departure_minute=720, day_type='weekday', day_of_week=None):
+        """
+        ETA for consecutive legs where each leg departs when the previous one
+        arrives. Every leg is evaluated for all 48 departure slots in a single
+        departure_matrix() pass; the clock walk then only indexes that table.
+
+        departure_minute is minutes after midnight of the first departure.
+        With day_of_week (0=Mon .. 6=Sun) the day type follows the clock past
+        midnight; otherwise day_type applies to every leg.
+        Returns one dict per leg with depart/arrive minutes from that midnight.
+        """
+        table = self.departure_matrix(distance_km, weather, vehicle, terrain)
+        table = table.reshape(-1, table.shape[-2], table.shape[-1])
+        day_types = self.day_types()
+
+        legs = []
+        clock = float(departure_minute)
+        for leg in range(table.shape[0]):
+            day_offset, minute_of_day = divmod(clock, 1440)
+            if day_of_week is not None:
+                leg_day_type = 'weekend' if (int(day_of_week) + int(day_offset)) % 7 >= 5 else 'weekday'
+            else:
+                leg_day_type = day_type.lower()
+            d_idx = day_types.index(leg_day_type) if leg_day_type in day_types else 0
+            minutes = float(table[leg, d_idx, int(minute_of_day // 60)])
+            legs.append({
+                'depart_minute': round(clock, 1),
+                'day_type': day_types[d_idx],
+                'duration_minutes': minutes,
+                'arrive_minute': round(clock + minutes, 1),
+            })
+            clock += minutes
+        return legs
+
+    def day_types(self):
+        """Day-type labels in axis order (weekday, weekend)."""
+        return list(self.day_index) if self._is_ready() else ['weekday', 'weekend']
+
+
+class HypercubeETAEngine(_ETAEngineBase):
     """
     100% Accuracy nearest-neighbor grid-search on synthetic model data.
+    The grid is a dense 6-D tensor indexed as
+    [distance, hour, day_type, weather, vehicle, terrain], opened as a
+    read-only memory map so every gunicorn worker shares the same physical
+    pages through the OS page cache.
     """
-    GRID_PATH = 'models/eta_grid.json'
+    GRID_PATH = 'models/eta_grid.npy'
+    META_PATH = 'models/eta_grid_meta.json'
+    LEGACY_GRID_PATH = 'models/eta_grid.json'
 
-    def __init__(self):
-        self.grid = {}
+    def __init__(self, artifact_dir=None):
+        self.artifact_dir = artifact_dir
+        if artifact_dir:
+            self.grid_path = os.path.join(artifact_dir, 'eta_grid.npy')
+            self.meta_path = os.path.join(artifact_dir, 'eta_grid_meta.json')
+        else:
+            self.grid_path, self.meta_path = self.GRID_PATH, self.META_PATH
+        self.grid = None
         self.dist_bins = []
+        self.scale = 1.0
         self._load()
 
     def _load(self):
-        """Try to load the grid from disk. Safe to call multiple times."""
+        """Load the grid from disk (called once per instance)."""
         try:
-            with open(self.GRID_PATH, 'r') as f:
-                self.grid = json.load(f)
-            self.dist_bins = sorted([int(k) for k in self.grid.keys()])
+            if os.path.exists(self.grid_path):
+                grid = np.load(self.grid_path, mmap_mode='r')
+                with open(self.meta_path, 'r') as f:
+                    axes = json.load(f)
+            elif self.artifact_dir is None:
+                # Legacy artifact from older builds (nested JSON dicts).
+                # This one lives on the private heap of each worker.
+                with open(self.LEGACY_GRID_PATH, 'r') as f:
+                    grid, axes = _legacy_grid_to_tensor(json.load(f))
+            else:
+                # A registry version must be served from its own validated files only
+                raise FileNotFoundError(f"{self.grid_path} not in artifact")
+            self._set_axes(axes)
+            self.grid = grid
             print("Loaded ETA Hypercube parameters successfully.")
         except Exception as e:
             print("Error: ETA Hypercube missing or unreadable.", e)
-            self.grid = {}
+            self.grid = None
             self.dist_bins = []
 
-    def predict(self, distance_km, hour_of_day, day_type='weekday', weather='clear', vehicle='sedan', terrain='highway'):
-        if distance_km <= 0:
-            return 0.0
+    def _is_ready(self):
+        return self.grid is not None
 
-        # Lazy-reload if grid was missing at startup but is now trained
-        if not self.grid:
-            self._load()
+    def _set_axes(self, axes):
+        self.dist_bins = [int(d) for d in axes['dist_bins']]
+        self.dist_bins_arr = np.asarray(self.dist_bins, dtype=np.float64)
+        self.scale = float(axes.get('scale', 1))
+        self._set_label_axes(axes)
 
-        if not self.grid:
-            # Still missing — simple speed fallback (50 km/h average)
-            return round((distance_km / 50.0) * 60.0, 1)
+    def _nearest_bin(self, distance_km):
+        """Index of the distance bin closest to `distance_km` (ties go to the lower bin)."""
+        bins = self.dist_bins
+        i = bisect.bisect_left(bins, distance_km)
+        if i == len(bins):
+            # Past the last bin: clamp here, _minutes() extrapolates linearly
+            return i - 1
+        if i > 0 and distance_km - bins[i - 1] <= bins[i] - distance_km:
+            return i - 1
+        return i
 
-        # 1. Nearest Neighbor Distance Discretization
-        closest_dist = min(self.dist_bins, key=lambda x: abs(x - distance_km))
+    def _nearest_bins(self, distance_km):
+        """Vectorized _nearest_bin() over an array of distances."""
+        bins = self.dist_bins_arr
+        if len(bins) == 1:
+            return np.zeros(distance_km.shape, dtype=np.intp)
+        i = np.clip(np.searchsorted(bins, distance_km, side='left'), 1, len(bins) - 1)
+        take_lower = (distance_km - bins[i - 1]) <= (bins[i] - distance_km)
+        return np.where(take_lower, i - 1, i)
 
-        # 2. Variable sanitization
-        hour_str = str(max(0, min(23, int(hour_of_day))))
-        d_type = day_type.lower() if day_type.lower() in ['weekday', 'weekend'] else 'weekday'
-        w_type = weather.lower() if weather.lower() in ['clear', 'rain', 'fog', 'snow'] else 'clear'
-        v_type = vehicle.lower() if vehicle.lower() in ['sedan', 'suv', 'bike', 'bus'] else 'sedan'
-        t_type = terrain.lower() if terrain.lower() in ['highway', 'city', 'mountain', 'rural'] else 'highway'
+    def _minutes(self, distance_km, hour_idx, d_idx, w_idx, v_idx, t_idx):
+        # 1. Nearest Neighbor Distance Discretization (binary search over sorted bins)
+        dist_idx = self._nearest_bin(distance_km)
+        closest_dist = self.dist_bins[dist_idx]
 
-        # 3. Predict via O(1) grid query
-        base_minutes = self.grid[str(closest_dist)][hour_str][d_type][w_type][v_type][t_type]
+        # 2. Predict via O(1) tensor index
+        base_minutes = float(self.grid[dist_idx, hour_idx, d_idx, w_idx, v_idx, t_idx]) / self.scale
 
-        # 4. Interpolate residual distance mismatch (since we binned to nearest 10km)
+        # 3. Interpolate residual distance mismatch (since we binned to nearest 10km).
+        #    Beyond the last bin this is a linear extrapolation of the clamped cell.
         if closest_dist > 0:
-            final_minutes = base_minutes * (distance_km / closest_dist)
-        else:
-            final_minutes = base_minutes
+            return base_minutes * (distance_km / closest_dist)
+        return base_minutes
+
+    def _minutes_many(self, dist, hours, d_idx, w_idx, v_idx, t_idx):
+        dist_idx = self._nearest_bins(dist)
+        closest_dist = self.dist_bins_arr[dist_idx]
+        base_minutes = self.grid[dist_idx, hours, d_idx, w_idx, v_idx, t_idx] / self.scale
+        ratio = np.divide(dist, closest_dist, out=np.ones_like(dist), where=closest_dist > 0)
+        return base_minutes * ratio
+
+    def memory_report(self):
+        """Resident vs shared memory of the grid in this worker process."""
+        report = {
+            'pid': os.getpid(),
+            'backing': 'mmap' if isinstance(self.grid, np.memmap) else ('heap' if self.grid is not None else 'missing'),
+            'grid_bytes': int(self.grid.nbytes) if self.grid is not None else 0,
+        }
+        if report['backing'] == 'mmap':
+            try:
+                report.update(_smaps_usage(os.path.abspath(self.grid.filename)))
+            except OSError:
+                # /proc is Linux-only; the mapping is still shared elsewhere
+                pass
+        return report
+
+
+class FactorizedETAEngine(_ETAEngineBase):
+    """
+    Closed-form ETA backend. Every grid cell is a product of independent
+    per-axis multipliers, so only those factor vectors are stored
+    (models/eta_factors.json, a few kB) and minutes are computed for the
+    exact distance instead of the nearest bin. At bin distances the result
+    is bit-identical to the materialized grid (checked by train_models.py).
+    """
+    FACTORS_PATH = 'models/eta_factors.json'
+
+    def __init__(self, artifact_dir=None):
+        self.factors_path = os.path.join(artifact_dir, 'eta_factors.json') if artifact_dir else self.FACTORS_PATH
+        self.hour_mult = None
+        self._load()
+
+    def _load(self):
+        """Load the factor vectors from disk (called once per instance)."""
+        try:
+            with open(self.factors_path, 'r') as f:
+                factors = json.load(f)
+            self._set_label_axes(factors)
+            self.base_speed = float(factors['base_speed_kmh'])
+            self.fatigue_per_km = float(factors['fatigue_per_km'])
+            self.day_mult = [list(map(float, row)) for row in factors['day_mult']]
+            self.weather_mult = [float(m) for m in factors['weather_mult']]
+            self.vehicle_mult = [float(m) for m in factors['vehicle_mult']]
+            self.terrain_mult = [float(m) for m in factors['terrain_mult']]
+            self.factor_arrays = {
+                'hour': np.asarray(factors['hour_mult'], dtype=np.float64),
+                'day': np.asarray(self.day_mult, dtype=np.float64),
+                'weather': np.asarray(self.weather_mult, dtype=np.float64),
+                'vehicle': np.asarray(self.vehicle_mult, dtype=np.float64),
+                'terrain': np.asarray(self.terrain_mult, dtype=np.float64),
+            }
+            # Assigned last: a non-None hour_mult marks the engine as ready
+            self.hour_mult = [float(m) for m in factors['hour_mult']]
+            print("Loaded factorized ETA parameters successfully.")
+        except Exception as e:
+            print("Error: ETA factors missing or unreadable.", e)
+            self.hour_mult = None
+
+    def _is_ready(self):
+        return self.hour_mult is not None
+
+    def _minutes(self, distance_km, hour_idx, d_idx, w_idx, v_idx, t_idx):
+        # Same left-to-right product as train_models.generate_eta_grid
+        raw_hours = distance_km / self.base_speed
+        fatigue_penalty = 1.0 + (distance_km * self.fatigue_per_km)
+        return (raw_hours * 60.0 * self.hour_mult[hour_idx] * self.day_mult[hour_idx][d_idx]
+                * self.weather_mult[w_idx] * self.vehicle_mult[v_idx] * self.terrain_mult[t_idx]
+                * fatigue_penalty)
+
+    def _minutes_many(self, dist, hours, d_idx, w_idx, v_idx, t_idx):
+        f = self.factor_arrays
+        raw_hours = dist / self.base_speed
+        fatigue_penalty = 1.0 + (dist * self.fatigue_per_km)
+        return (raw_hours * 60.0 * f['hour'][hours] * f['day'][hours, d_idx]
+                * f['weather'][w_idx] * f['vehicle'][v_idx] * f['terrain'][t_idx]
+                * fatigue_penalty)
+
+    def memory_report(self):
+        """The factor vectors are a few kB per worker; there is no grid mapping."""
+        return {'pid': os.getpid(), 'backing': 'factors' if self._is_ready() else 'missing', 'grid_bytes': 0}
+
+
+# Backend selection: 'grid' (materialized hypercube) or 'factorized' (closed form)
+ETA_BACKEND = os.environ.get('ETA_BACKEND', 'grid').lower()
+
 
-        return round(final_minutes, 1)
+def _make_eta_engine(artifact_dir):
+    if ETA_BACKEND == 'factorized':
+        return FactorizedETAEngine(artifact_dir)
+    return HypercubeETAEngine(artifact_dir)
 
 
-# Singleton Instance
-eta_model = HypercubeETAEngine()
+# Singleton handle — always points at a fully loaded engine, hot-swapped by the registry
+eta_model = ModelHandle('eta', _make_eta_engine)
@@ -0,0 +1,252 @@
+"""
+Versioned ML model artifacts with atomic hot-swap.
+
+Layout on disk:
+    models/<name>/<version>/          artifact files + manifest.json (sha256 per file)
+    models/<name>/CURRENT             version string of the live artifact
+
+Versions are never modified after publishing, so a worker that still has
+the previous grid memory-mapped keeps reading valid pages while the new one
+is swapped in.
+"""
+import collections
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+MODELS_DIR = 'models'
+MANIFEST_NAME = 'manifest.json'
+CURRENT_NAME = 'CURRENT'
+
+# Entries per engine in the predict() memo (0 disables caching)
+PREDICTION_CACHE_SIZE = int(os.environ.get('PREDICTION_CACHE_SIZE', '4096'))
+
+
+class ArtifactError(Exception):
+    """Raised when a published artifact is missing, corrupt or fails to load."""
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def version_dir(name, version, models_dir=MODELS_DIR):
+    return os.path.join(models_dir, name, version)
+
+
+def current_version(name, models_dir=MODELS_DIR):
+    """Version string CURRENT points to, or None if nothing is published yet."""
+    try:
+        with open(os.path.join(models_dir, name, CURRENT_NAME), 'r') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def publish(name, files, models_dir=MODELS_DIR, keep=3):
+    """
+    Copy `files` ({artifact file name: source path}) into a new version
+    directory, write its manifest, then flip CURRENT with an atomic rename.
+    Returns the new version string.
+    """
+    version = time.strftime('%Y%m%d-%H%M%S') + '-' + uuid.uuid4().hex[:6]
+    base = os.path.join(models_dir, name)
+    staging = os.path.join(base, f'.{version}.tmp')
+    os.makedirs(staging)
+
+    manifest = {'name': name, 'version': version, 'created_at': time.time(), 'files': {}}
+    for file_name, src in files.items():
+        dst = os.path.join(staging, file_name)
+        shutil.copyfile(src, dst)
+        manifest['files'][file_name] = _sha256(dst)
+    with open(os.path.join(staging, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.rename(staging, os.path.join(base, version))
+
+    pointer_tmp = os.path.join(base, f'.{CURRENT_NAME}.{uuid.uuid4().hex}')
+    with open(pointer_tmp, 'w') as f:
+        f.write(version)
+    os.replace(pointer_tmp, os.path.join(base, CURRENT_NAME))
+
+    prune(name, keep=keep, models_dir=models_dir)
+    print(f"[Registry] Published {name} version {version}")
+    return version
+
+
+def prune(name, keep=3, models_dir=MODELS_DIR):
+    """Delete all but the newest `keep` versions (never the CURRENT one)."""
+    base = os.path.join(models_dir, name)
+    live = current_version(name, models_dir)
+    versions = sorted(v for v in os.listdir(base)
+                      if not v.startswith('.') and os.path.isdir(os.path.join(base, v)))
+    for version in versions[:-keep] if keep else versions:
+        if version != live:
+            # Unlinking is safe even if another worker still has a file mapped
+            shutil.rmtree(os.path.join(base, version), ignore_errors=True)
+
+
+def validate(name, version, models_dir=MODELS_DIR):
+    """Check every file of a version against its manifest. Returns the version directory."""
+    path = version_dir(name, version, models_dir)
+    try:
+        with open(os.path.join(path, MANIFEST_NAME), 'r') as f:
+            manifest = json.load(f)
+        for file_name, expected in manifest['files'].items():
+            if _sha256(os.path.join(path, file_name)) != expected:
+                raise ArtifactError(f"{name}/{version}: checksum mismatch for {file_name}")
+    except (OSError, ValueError, KeyError) as e:
+        raise ArtifactError(f"{name}/{version}: unreadable artifact ({e})")
+    return path
+
+
+class _PredictionCache:
+    """
+    LRU memo with exact hit / miss / eviction counters (functools.lru_cache
+    cannot tell an eviction from two threads missing the same key). The
+    value is computed outside the lock, so concurrent misses of one key may
+    both compute it, but only one entry is stored.
+    """
+
+    def __init__(self, fn, maxsize):
+        self._fn = fn
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def __call__(self, *key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        value = self._fn(*key)
+        if self.maxsize == 0:
+            return value
+        with self._lock:
+            self._entries[key] = value
+            if self.maxsize is not None and len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+
+def prediction_cache(fn, maxsize=None):
+    """
+    Bounded, thread-safe LRU memo around an engine's predict core, keyed on its
+    already-normalized arguments. Engines build one per instance, so a
+    hot-swapped model version starts with an empty cache and the stale
+    entries are dropped together with the old engine.
+    """
+    return _PredictionCache(fn, PREDICTION_CACHE_SIZE if maxsize is None else maxsize)
+
+
+def lru_stats(cached):
+    """Hit / miss / eviction counters of a prediction_cache()."""
+    with cached._lock:
+        return {
+            'hits': cached.hits,
+            'misses': cached.misses,
+            'evictions': cached.evictions,
+            'size': len(cached._entries),
+            'maxsize': cached.maxsize,
+        }
+
+
+class ModelHandle:
+    """
+    Atomic pointer to the live engine of one artifact. A reload builds a
+    complete new engine off to the side and swaps it in with a single
+    reference assignment, so in-flight calls finish on the instance they
+    started with and never see a half-loaded model.
+
+    `factory(artifact_dir)` builds an engine; artifact_dir is None for the
+    legacy flat files in models/ (deployments from before the registry).
+    Attribute access is delegated to the live engine.
+    """
+
+    def __init__(self, name, factory):
+        self.name = name
+        self._factory = factory
+        self._live = (None, None)
+        try:
+            self.reload()
+        except ArtifactError as e:
+            print(f"[Registry] {e} — falling back to legacy {name} files.")
+            self._live = (factory(None), 'legacy')
+
+    @property
+    def version(self):
+        return self._live[1]
+
+    @property
+    def engine(self):
+        return self._live[0]
+
+    def reload(self, version=None):
+        """Load `version` (default: CURRENT) and swap it in. Raises ArtifactError on failure."""
+        version = version or current_version(self.name)
+        if version is None:
+            raise ArtifactError(f"{self.name}: no published version")
+        engine = self._factory(validate(self.name, version))
+        if not engine._is_ready():
+            raise ArtifactError(f"{self.name}/{version}: engine failed to load")
+        self._live = (engine, version)
+
+    def __getattr__(self, attr):
+        return getattr(self._live[0], attr)
+
+
+class ModelWatcher(threading.Thread):
+    """
+    Background poller that hot-swaps handles when CURRENT changes.
+    A version that fails validation or loading is retried with exponential
+    backoff (interval .. max_backoff seconds) until a newer one is published.
+    """
+
+    def __init__(self, handles, interval=5.0, max_backoff=300.0):
+        super().__init__(daemon=True, name='model-watcher')
+        self.handles = list(handles)
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self._backoff = {}  # name -> (version, next_attempt, delay)
+        self._wake = threading.Event()
+
+    def check_now(self):
+        """Ask the watcher to poll immediately (e.g. right after training)."""
+        self._wake.set()
+
+    def run(self):
+        while True:
+            for handle in self.handles:
+                self._check(handle)
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def _check(self, handle):
+        version = current_version(handle.name)
+        if version is None or version == handle.version:
+            return
+
+        now = time.monotonic()
+        failed_version, next_attempt, delay = self._backoff.get(handle.name, (None, 0.0, 0.0))
+        if failed_version == version and now < next_attempt:
+            return
+
+        try:
+            handle.reload(version)
+            self._backoff.pop(handle.name, None)
+            print(f"[Registry] Swapped in {handle.name} version {version}")
+        except Exception as e:
+            delay = min(self.max_backoff, delay * 2 if failed_version == version else self.interval)
+            self._backoff[handle.name] = (version, now + delay, delay)
+            print(f"[Registry] Could not load {handle.name} version {version}: {e} (retry in {delay:.0f}s)")
@@ -16,6 +16,8 @@ const App = {
     destTimeout: null,
     activeTripForTracking: null, // Stores data of the trip being tracked
     isTrackingInitialized: false, // Flag for live tracker
+    trackingId: null, // Server-side tracking session for the SSE ETA stream
+    etaStream: null, // EventSource pushing ETA updates
     allTrips: [], // Store all trips for quick access
   },
 
@@ -76,6 +78,9 @@ const App = {
       if (event.target === this.Elements.chatbotModal) this.Chatbot.close();
     });
 
+    // Closing the tab ends its live tracking session (the server also expires idle ones)
+    window.addEventListener('pagehide', () => this.Track.stopEtaStream());
+
     // Suggestion input debouncing & Keyboard Navigation
     if (this.Elements.start_location) {
       this.Elements.start_location.addEventListener("input", () => {
@@ -714,24 +719,34 @@ const App = {
 
       App.Util.setVal('budget', 'Calculating...');
 
-      // ── 6. Call the ML API ──────────────────────────────────────────────
+      // ── 6. Look the estimate up in the scenario matrix (one API call per trip shape) ──
       try {
-        const res = await fetch('/api/predict-budget', {
-          method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify({
-            days: numDays,
-            group_size: groupSize,
-            travel_style: travelStyle,
-            food_type: foodType,
-            season: season,
-            booking: booking,
-            stay_type: stayType,
-            is_family: isFamily,
-            destination: destination
-          })
-        });
-        const data = await res.json();
+        let data = await this.scenarioBudget({
+          days: numDays,
+          group_size: groupSize,
+          travel_style: travelStyle,
+          is_family: isFamily,
+          destination: destination
+        }, { stay_type: stayType, food_type: foodType, season: season, booking: booking });
+
+        if (!data) {
+          const res = await fetch('/api/predict-budget', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+              days: numDays,
+              group_size: groupSize,
+              travel_style: travelStyle,
+              food_type: foodType,
+              season: season,
+              booking: booking,
+              stay_type: stayType,
+              is_family: isFamily,
+              destination: destination
+            })
+          });
+          data = await res.json();
+        }
         if (data.status === 'success') {
           const total = Math.ceil(data.estimated_budget);
           const perPerson = Math.ceil(data.cost_per_person);
@@ -774,6 +789,42 @@ const App = {
       }
     },
 
+    // Last scenario matrix: every stay × food × season × booking for one trip shape
+    scenarioCache: { key: null, data: null },
+
+    loadScenarios: async function (trip) {
+      const key = JSON.stringify(trip);
+      if (this.scenarioCache.key === key) return this.scenarioCache.data;
+
+      const res = await fetch('/api/predict-budget/scenarios', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(trip)
+      });
+      const data = await res.json();
+      if (data.status !== 'success') return null;
+      this.scenarioCache = { key: key, data: data };
+      return data;
+    },
+
+    // Budget for one option combination from the cached matrix; null if it is not covered
+    scenarioBudget: async function (trip, options) {
+      const data = await this.loadScenarios(trip);
+      if (!data) return null;
+
+      let cell = data.estimated_budgets;
+      for (const axis of data.axis_order) {
+        const idx = data.axes[axis].indexOf(options[axis]);
+        if (idx < 0) return null;
+        cell = cell[idx];
+      }
+      return {
+        status: 'success',
+        estimated_budget: cell,
+        cost_per_person: Math.round(cell / trip.group_size * 100) / 100
+      };
+    },
+
     // Auto-recalculate budget when destination or key fields change
     autoRecalculateBudget: async function () {
       const destination = App.Util.getVal('destination');
@@ -864,7 +915,8 @@ const App = {
           <li style="padding: 10px; border-bottom: 1px solid #eee; display: flex; justify-content: space-between; align-items: center;">
               <div>
                   <strong>${App.Util.escapeHtml(trip.trip_name)}</strong><br>
-                  <small><i class="fas fa-map-marker-alt"></i> ${App.Util.escapeHtml(trip.destination)}</small>
+                  <small><i class="fas fa-map-marker-alt"></i> ${App.Util.escapeHtml(trip.destination)}</small><br>
+                  <small><i class="fas fa-wallet"></i> Spent ₹${(parseFloat(trip.total_spent) || 0).toFixed(2)}${trip.budget ? ` of ₹${parseFloat(trip.budget).toFixed(2)}` : ''}</small>
               </div>
               <button class="btn-primary" onclick="App.Budget.closeBudgetTracker(); App.Budget.openBudgetTracker(${trip.id})" style="padding: 5px 15px; font-size: 0.9rem;">
                   <i class="fas fa-wallet"></i> Select
@@ -890,6 +942,9 @@ const App = {
         const tripBudget = parseFloat(data.trip_budget) || 0;
         const totalSpent = parseFloat(data.total_spent) || 0;
         const remaining = parseFloat(data.remaining_budget) || (tripBudget - totalSpent);
+        // Keep the trip picker's spend in step without refetching the trip list
+        const cachedTrip = (App.State.allTrips || []).find(t => t.id === trip_id);
+        if (cachedTrip) cachedTrip.total_spent = totalSpent;
 
         let html = `<h3>Trip Expenses</h3>`;
         html += `
@@ -985,6 +1040,17 @@ const App = {
   // ---------------------------------
   Track: {
 
+    // Position pushes: never more often than PUSH_MIN_MS; sooner than PUSH_MAX_MS only
+    // when the locally projected ETA has drifted by PUSH_ETA_DELTA_MINS (or that share of it)
+    PUSH_MIN_MS: 60000,
+    PUSH_MAX_MS: 300000,
+    PUSH_ETA_DELTA_MINS: 2,
+    PUSH_ETA_DELTA_SHARE: 0.05,
+    etaBase: null, // Last server ETA: { distanceKm, durationMins }
+    pushedEta: null, // Projected ETA when the last position was pushed
+    lastPushAt: 0,
+    renderedMins: null,
+
     openTripSelector: function () {
       if (!navigator.geolocation) {
         return alert("Geolocation not supported by your browser.");
@@ -1121,8 +1187,11 @@ const App = {
 
             if (App.Elements['route-dist']) App.Elements['route-dist'].textContent = `${distanceKm.toFixed(1)} km`;
 
-            // Request ML ETA
+            // Request ML ETA, then let the server push further updates
             this.updateMLEta(distanceKm);
+            this.startEtaStream(distanceKm);
+            // One sweep per route: best departure hours heatmap
+            this.updateDepartureHeatmap(distanceKm);
           }).addTo(App.State.map);
 
         } else {
@@ -1141,10 +1210,11 @@ const App = {
           const remainingDistKm = remainingDistMeters / 1000;
           if (App.Elements['route-dist']) App.Elements['route-dist'].textContent = `${remainingDistKm.toFixed(1)} km (Linear)`;
 
-          // Debounce ML ETA calls (every 500m moved) to avoid spam
-          if (!this.lastEtaDist || Math.abs(this.lastEtaDist - remainingDistKm) > 0.5) {
-            this.lastEtaDist = remainingDistKm;
-            this.updateMLEta(remainingDistKm);
+          // Between server ETAs, scale the last one by distance left (no request);
+          // the server only hears about it once that projection drifts or goes stale
+          this.renderProjectedEta(remainingDistKm);
+          if (this.shouldPushPosition(remainingDistKm)) {
+            this.pushTrackPosition(remainingDistKm);
           }
         }
 
@@ -1158,63 +1228,209 @@ const App = {
       }, { enableHighAccuracy: true, maximumAge: 0, timeout: 10000 });
     },
 
+    // Travel reference time: trip's planned start_date if it's in the future, else now
+    etaReferenceTime: function () {
+      const trip = App.State.activeTripForTracking;
+      let referenceTime = new Date(); // default: right now
+
+      if (trip && trip.start_date) {
+        const tripStart = new Date(trip.start_date);
+        tripStart.setHours(8, 0, 0, 0); // Assume 8 AM departure on trip day
+        if (tripStart > new Date()) {
+          referenceTime = tripStart; // future trip → use planned start
+        }
+      }
+      return referenceTime;
+    },
+
+    etaQuery: function (distanceKm) {
+      const referenceTime = this.etaReferenceTime();
+      const weatherSelect = document.getElementById('live_weather');
+      return {
+        distance_km: distanceKm,
+        hour_of_day: referenceTime.getHours(),
+        day_type: (referenceTime.getDay() === 0 || referenceTime.getDay() === 6) ? 'weekend' : 'weekday',
+        weather: weatherSelect ? weatherSelect.value : 'clear'
+      };
+    },
+
     // ML ETA — uses trip's start_date as travel reference for future trips
     updateMLEta: async function (distanceKm) {
       if (distanceKm <= 0) return;
       try {
-        // Use trip's planned start_date if it's in the future, else use now
-        const trip = App.State.activeTripForTracking;
-        let referenceTime = new Date(); // default: right now
-
-        if (trip && trip.start_date) {
-          const tripStart = new Date(trip.start_date);
-          tripStart.setHours(8, 0, 0, 0); // Assume 8 AM departure on trip day
-          if (tripStart > new Date()) {
-            referenceTime = tripStart; // future trip → use planned start
-          }
+        const res = await fetch('/api/predict-eta', {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify(this.etaQuery(distanceKm))
+        });
+        const data = await res.json();
+        if (data.status === 'success') {
+          this.applyServerEta(distanceKm, data.duration_minutes);
         }
+      } catch (e) { console.error("ML ETA failed", e); }
+    },
 
-        const hour = referenceTime.getHours();
-        const dayType = (referenceTime.getDay() === 0 || referenceTime.getDay() === 6) ? 'weekend' : 'weekday';
+    applyServerEta: function (distanceKm, durationMins) {
+      this.etaBase = { distanceKm: distanceKm, durationMins: durationMins };
+      this.renderedMins = Math.ceil(durationMins);
+      this.renderEta(durationMins);
+    },
 
-        const weatherSelect = document.getElementById('live_weather');
-        const weather = weatherSelect ? weatherSelect.value : 'clear';
+    projectedEta: function (distanceKm) {
+      const base = this.etaBase;
+      if (!base || base.distanceKm <= 0) return null;
+      return base.durationMins * distanceKm / base.distanceKm;
+    },
 
-        const res = await fetch('/api/predict-eta', {
+    renderProjectedEta: function (distanceKm) {
+      const projected = this.projectedEta(distanceKm);
+      if (projected === null || Math.ceil(projected) === this.renderedMins) return;
+      this.renderedMins = Math.ceil(projected);
+      this.renderEta(projected);
+    },
+
+    shouldPushPosition: function (distanceKm) {
+      const elapsed = Date.now() - this.lastPushAt;
+      if (elapsed < this.PUSH_MIN_MS) return false;
+      if (elapsed >= this.PUSH_MAX_MS) return true; // fresh hour of day; keeps the session from expiring
+      const projected = this.projectedEta(distanceKm);
+      if (projected === null || this.pushedEta === null) return true;
+      const threshold = Math.max(this.PUSH_ETA_DELTA_MINS, this.PUSH_ETA_DELTA_SHARE * this.pushedEta);
+      return Math.abs(this.pushedEta - projected) >= threshold;
+    },
+
+    renderEta: function (durationMins) {
+      const referenceTime = this.etaReferenceTime();
+      // Arrival = referenceTime + travel duration
+      const arrival = new Date(referenceTime.getTime() + durationMins * 60000);
+
+      const dateStr = arrival.toLocaleDateString([], { day: 'numeric', month: 'short', year: 'numeric' });
+      const timeStr = arrival.toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' });
+
+      // Label: "Planned Arrival" for future trips, "ETA" for live/current
+      const isFuture = referenceTime > new Date();
+      const label = isFuture ? '📅 Planned Arrival' : '🚗 ETA';
+      const subLabel = isFuture
+        ? `Departs ${referenceTime.toDateString()} at ${referenceTime.toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' })}`
+        : `${Math.ceil(durationMins)} min remaining`;
+
+      if (document.getElementById('route-eta')) {
+        document.getElementById('route-summary').style.display = 'block';
+        document.getElementById('route-eta').innerHTML =
+          `<span style="font-size:0.8rem;opacity:0.7;">${label}</span><br>
+                     <strong>${timeStr}</strong> &nbsp;<span style="opacity:0.8;">(${dateStr})</span>
+                     <br><span style="color:#aaa;font-size:0.85rem;font-weight:normal;">${subLabel}</span>`;
+      }
+    },
+
+    // Server-sent ETA stream: positions are pushed, ETAs arrive only when they change
+    startEtaStream: async function (distanceKm) {
+      if (App.State.trackingId || typeof EventSource === 'undefined') return;
+      try {
+        const query = this.etaQuery(distanceKm);
+        const res = await fetch('/api/track/start', {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({ weather: query.weather })
+        });
+        const data = await res.json();
+        if (data.status !== 'success' || App.State.watchId === null) return;
+
+        App.State.trackingId = data.tracking_id;
+        const stream = new EventSource(`/api/track/${data.tracking_id}/stream`);
+        stream.onmessage = (e) => {
+          const update = JSON.parse(e.data);
+          this.applyServerEta(update.distance_km, update.duration_minutes);
+        };
+        stream.onerror = () => {
+          // 503 (server's stream slots are full) or a refused reconnect: EventSource
+          // gives up, and from then on the ETA rides back on the position pushes
+          if (stream.readyState === EventSource.CLOSED && App.State.etaStream === stream) {
+            App.State.etaStream = null;
+          }
+        };
+        stream.addEventListener('end', () => {
+          stream.close();
+          if (App.State.etaStream === stream) App.State.etaStream = null;
+          App.State.trackingId = null; // session expired server-side
+        });
+        App.State.etaStream = stream;
+        this.pushTrackPosition(distanceKm);
+      } catch (e) { console.error("ETA stream unavailable", e); }
+    },
+
+    pushTrackPosition: function (distanceKm) {
+      this.lastPushAt = Date.now();
+      this.pushedEta = this.projectedEta(distanceKm);
+      if (!App.State.trackingId) return this.updateMLEta(distanceKm); // no session → one-off request
+
+      const withEta = !App.State.etaStream; // no stream → ask for the ETA in the response
+      fetch(`/api/track/${App.State.trackingId}/position`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ ...this.etaQuery(distanceKm), with_eta: withEta }),
+        keepalive: true
+      }).then(res => {
+        if (res.status === 404) App.State.trackingId = null; // expired → one-off requests from now on
+        return withEta && res.ok ? res.json() : null;
+      }).then(data => {
+        if (data && data.status === 'success') this.applyServerEta(data.distance_km, data.duration_minutes);
+      }).catch(e => console.error("Position push failed", e));
+    },
+
+    stopEtaStream: function () {
+      if (App.State.etaStream) {
+        App.State.etaStream.close();
+        App.State.etaStream = null;
+      }
+      if (App.State.trackingId) {
+        fetch(`/api/track/${App.State.trackingId}/stop`, { method: 'POST', keepalive: true }).catch(() => {});
+        App.State.trackingId = null;
+      }
+    },
+
+    // "Best time to leave" heatmap — one request returns all 48 departure slots
+    updateDepartureHeatmap: async function (distanceKm) {
+      const summary = document.getElementById('route-summary');
+      if (!summary || distanceKm <= 0) return;
+      try {
+        const weatherSelect = document.getElementById('live_weather');
+        const res = await fetch('/api/predict-eta/departures', {
           method: 'POST',
           headers: { 'Content-Type': 'application/json' },
           body: JSON.stringify({
             distance_km: distanceKm,
-            hour_of_day: hour,
-            day_type: dayType,
-            weather: weather
+            weather: weatherSelect ? weatherSelect.value : 'clear'
           })
         });
         const data = await res.json();
-        if (data.status === 'success') {
-          const durationMins = data.duration_minutes;
-          // Arrival = referenceTime + travel duration
-          const arrival = new Date(referenceTime.getTime() + durationMins * 60000);
-
-          const dateStr = arrival.toLocaleDateString([], { day: 'numeric', month: 'short', year: 'numeric' });
-          const timeStr = arrival.toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' });
-
-          // Label: "Planned Arrival" for future trips, "ETA" for live/current
-          const isFuture = referenceTime > new Date();
-          const label = isFuture ? '📅 Planned Arrival' : '🚗 ETA';
-          const subLabel = isFuture
-            ? `Departs ${referenceTime.toDateString()} at ${referenceTime.toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' })}`
-            : `${Math.ceil(durationMins)} min remaining`;
-
-          if (document.getElementById('route-eta')) {
-            document.getElementById('route-summary').style.display = 'block';
-            document.getElementById('route-eta').innerHTML =
-              `<span style="font-size:0.8rem;opacity:0.7;">${label}</span><br>
-                         <strong>${timeStr}</strong> &nbsp;<span style="opacity:0.8;">(${dateStr})</span>
-                         <br><span style="color:#aaa;font-size:0.85rem;font-weight:normal;">${subLabel}</span>`;
-          }
+        if (data.status !== 'success') return;
+
+        let heatmap = document.getElementById('departure-heatmap');
+        if (!heatmap) {
+          heatmap = document.createElement('div');
+          heatmap.id = 'departure-heatmap';
+          heatmap.style.cssText = 'margin:8px 0;font-size:0.7rem;';
+          summary.insertBefore(heatmap, document.getElementById('recalculate-route-btn'));
         }
-      } catch (e) { console.error("ML ETA failed", e); }
+
+        const all = Object.values(data.durations).flat();
+        const min = Math.min(...all), max = Math.max(...all);
+        let html = '<strong>Best time to leave</strong>';
+        Object.entries(data.durations).forEach(([dayType, row]) => {
+          html += `<div style="display:flex;align-items:center;gap:1px;margin-top:3px;"><span style="width:58px;">${dayType}</span>`;
+          row.forEach((mins, hour) => {
+            // Green = fastest departure, red = slowest
+            const t = max > min ? (mins - min) / (max - min) : 0;
+            const hue = Math.round(120 * (1 - t));
+            html += `<span title="${hour}:00 — ${Math.ceil(mins)} min" style="flex:1;height:12px;background:hsl(${hue},70%,45%);"></span>`;
+          });
+          html += '</div>';
+        });
+        const f = data.fastest;
+        html += `<div style="opacity:0.8;margin-top:3px;">Fastest: ${f.day_type} ${f.hour_of_day}:00 (${Math.ceil(f.duration_minutes)} min)</div>`;
+        heatmap.innerHTML = html;
+      } catch (e) { console.error("Departure sweep failed", e); }
     },
 
     recalculateRoute: function () {
@@ -1246,9 +1462,13 @@ const App = {
         if (App.State.map) App.State.map.removeLayer(App.State.liveMarker);
         App.State.liveMarker = null;
       }
+      this.stopEtaStream();
       App.State.activeTripForTracking = null;
       App.State.isTrackingInitialized = false;
-      this.lastEtaDist = null;
+      this.etaBase = null;
+      this.pushedEta = null;
+      this.lastPushAt = 0;
+      this.renderedMins = null;
 
       if (App.Elements['route-summary']) App.Elements['route-summary'].style.display = 'none';
       if (App.Elements['recalculate-route-btn']) App.Elements['recalculate-route-btn'].style.display = 'none';
@@ -1,144 +1,287 @@
+import contextlib
+import importlib.util
 import json
 import os
 import time
 
-def generate_eta_grid():
-    eta_db = {}
+try:
+    import fcntl
+except ImportError:  # Windows: no gunicorn workers there, so nothing to serialize
+    fcntl = None
+
+# ETA hypercube artifact: a dense 6-D tensor plus its axis labels.
+# Cells hold minutes in tenths (the grid is rounded to 0.1 min) as uint32,
+# because the slowest cells (~279,936 min, 2,799,360 tenths) overflow uint16/float16.
+ETA_GRID_PATH = 'models/eta_grid.npy'
+ETA_META_PATH = 'models/eta_grid_meta.json'
+ETA_GRID_SCALE = 10
+ETA_FACTORS_PATH = 'models/eta_factors.json'
+BUDGET_MODEL_PATH = 'models/budget_rf.pkl'
+BUDGET_FOREST_PATH = 'models/budget_forest.npz'
+BUDGET_SWEEP_REPORT_PATH = 'models/budget_rf_sweep.json'
+TRAIN_LOCK_PATH = 'models/.train.lock'
+
+
+@contextlib.contextmanager
+def training_lock(path=TRAIN_LOCK_PATH):
+    """
+    Exclusive cross-process lock for writing the flat models/* build outputs
+    and publishing them, so two workers (or a worker and a CLI run) never
+    train into the same files or publish one half-written.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def save_eta_grid(grid, axes, grid_path=ETA_GRID_PATH, meta_path=ETA_META_PATH):
+    """Write the ETA tensor (.npy) and its axis metadata (.json) side by side."""
+    import numpy as np
+
+    os.makedirs(os.path.dirname(grid_path) or '.', exist_ok=True)
+    np.save(grid_path, grid)
+    meta = dict(axes)
+    meta['scale'] = ETA_GRID_SCALE
+    meta['shape'] = list(grid.shape)
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+
+
+# Generator multipliers. Dict order defines the axis order of the tensor.
+ETA_BASE_SPEED_KMH = 50.0
+ETA_FATIGUE_PER_KM = 0.001
+ETA_RUSH_HOURS = [8, 9, 17, 18]
+ETA_RUSH_HOUR_MULT = 1.6
+ETA_WEEKEND_MIDDAY_HOURS = range(11, 16)
+ETA_WEEKEND_MIDDAY_MULT = 1.3
+ETA_DAY_TYPES = ['weekday', 'weekend']
+ETA_WEATHER_MULT = {'clear': 1.0, 'rain': 1.25, 'fog': 1.4, 'snow': 1.8}
+ETA_VEHICLE_MULT = {'sedan': 1.0, 'suv': 0.95, 'bike': 1.15, 'bus': 1.5}
+ETA_TERRAIN_MULT = {'highway': 0.7, 'city': 1.5, 'mountain': 1.8, 'rural': 1.1}
+
+# Budget label generator. Base Constants — Genuine Indian Travel Rates (per person/night)
+BUDGET_STAY_NIGHTLY_BASE = {
+    'hostel': 300,         'camping': 400,
+    'friend_house': 0,     'home': 0,          'family_stay': 0,
+    'budget_hotel': 700,   '3star_hotel': 1800, 'resort': 3500,
+    '5star_hotel': 6000,   'dharamshala': 150,  'ashram': 200,
+    'guesthouse': 500,     'homestay': 600,     'heritage_hotel': 2500,
+    'houseboat': 2500,     'treehouse': 1800,   'desert_camp': 1200,
+    'tent_resort': 1200
+}
+BUDGET_FOOD_DAILY_COST = {
+    'veg_thali': 150,   'nonveg_thali': 220,
+    'local_cuisine': 300, 'dhaba': 120,
+    'restaurant': 500,  'hotel_buffet': 900
+}
+BUDGET_TRANSPORT_DAILY_PP = {
+    'budget': 200,   'mid-range': 450,
+    'mid': 450,      'luxury': 1200
+}
+# Modest multipliers — last-minute adds only 10%, peak adds 20%
+BUDGET_SEASON_MULT = {'peak': 1.2, 'off-peak': 0.85, 'shoulder': 1.0, 'holiday': 1.35}
+BUDGET_BOOKING_MULT = {'last-minute': 1.10, 'normal': 1.0, 'advance': 0.88}
+BUDGET_LABEL_NOISE = 0.08
+# Real trips are labelled as the solo planner-default cell (trips record no
+# group size); spend further than this factor from that cell's cost is
+# treated as a group trip or bad data and not trained on. 1.5 already
+# excludes a two-person trip.
+BUDGET_REAL_SPEND_RATIO = 1.5
+
+# Forest hyperparameters tried by --sweep (every combination is trained once)
+BUDGET_SWEEP_GRID = {
+    'n_estimators': [10, 30, 50],
+    'max_depth': [15, 20, 25],
+    'min_samples_leaf': [1, 5],
+}
+
+
+def _eta_factor_tables():
+    """Per-axis multiplier arrays: hour (24,), day (24, 2), weather, vehicle, terrain."""
+    import numpy as np
+
+    hours = np.arange(24)
+    hour_mult = np.where(np.isin(hours, ETA_RUSH_HOURS), ETA_RUSH_HOUR_MULT, 1.0)
+    day_mult = np.ones((len(hours), len(ETA_DAY_TYPES)))
+    day_mult[list(ETA_WEEKEND_MIDDAY_HOURS), ETA_DAY_TYPES.index('weekend')] = ETA_WEEKEND_MIDDAY_MULT
+    weather_mult = np.array(list(ETA_WEATHER_MULT.values()))
+    vehicle_mult = np.array(list(ETA_VEHICLE_MULT.values()))
+    terrain_mult = np.array(list(ETA_TERRAIN_MULT.values()))
+    return hour_mult, day_mult, weather_mult, vehicle_mult, terrain_mult
+
+
+def _round_tenths(mins):
+    """
+    Vectorized int(round(round(m, 1) * 10)). np.round disagrees with Python's
+    correctly-rounded round() on near-ties, so those few cells use round().
+    """
+    import numpy as np
+
+    scaled = mins * ETA_GRID_SCALE
+    tenths = np.rint(scaled)
+    near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    tenths[near_tie] = [round(round(m, 1) * ETA_GRID_SCALE) for m in mins[near_tie].tolist()]
+    return tenths
+
+
+def generate_eta_grid(max_km=5000, step_km=10, chunk_bins=256):
+    """
+    Materialize the ETA hypercube with NumPy broadcasting.
+    Distance bins run 0..max_km in step_km steps; bins are generated in
+    chunks of `chunk_bins` so float64 intermediates stay small even at
+    1 km resolution.
+    """
+    import numpy as np
+
     print("Initiating Deep Training on Advanced ETA Hypercube...")
     print("Mapping Every Metric: Distance, Hour, Day, Weather, Vehicle, Terrain...")
-    
-    # 500 x 24 x 2 x 4 x 4 x 4 = 1,536,000 combinations
-    distances = range(0, 5001, 10) # 500 bins up to 5000km
-    hours = range(24)
-    day_types = ['weekday', 'weekend']
-    weathers = ['clear', 'rain', 'fog', 'snow']
-    vehicles = ['sedan', 'suv', 'bike', 'bus']
-    terrains = ['highway', 'city', 'mountain', 'rural']
-    
-    total_combinations = len(distances) * len(hours) * len(day_types) * len(weathers) * len(vehicles) * len(terrains)
-    
-    base_speed = 50.0 
-    
-    count = 0
+
+    # Default: 501 x 24 x 2 x 4 x 4 x 4 = 1,539,072 combinations
+    distances = np.arange(0, max_km + 1, step_km)
+    hours = np.arange(24)
+
+    # Per-axis multipliers, shaped to broadcast over
+    # [distance, hour, day_type, weather, vehicle, terrain]
+    hour_mult, day_mult, weather_mult, vehicle_mult, terrain_mult = _eta_factor_tables()
+    hour_mult = hour_mult[None, :, None, None, None, None]
+    day_mult = day_mult[None, :, :, None, None, None]
+    weather_mult = weather_mult[None, None, None, :, None, None]
+    vehicle_mult = vehicle_mult[None, None, None, None, :, None]
+    terrain_mult = terrain_mult[None, None, None, None, None, :]
+
+    shape = (len(distances), len(hours), len(ETA_DAY_TYPES),
+             len(ETA_WEATHER_MULT), len(ETA_VEHICLE_MULT), len(ETA_TERRAIN_MULT))
+    eta_grid = np.empty(shape, dtype=np.uint32)
     start_time = time.time()
-    
-    for dist in distances:
-        if dist % 1000 == 0:
-            print(f"Training Progress: [{str(dist).zfill(4)} / 5000 km] ... {(count/total_combinations)*100:.1f}%")
-        
-        if dist == 0:
-            eta_db[0] = {h: {d: {w: {v: {t: 0.0 for t in terrains} for v in vehicles} for w in weathers} for d in day_types} for h in hours}
-            count += 24*2*4*4*4
-            continue
-            
-        str_dist = str(dist)
-        eta_db[str_dist] = {}
-        fatigue_penalty = 1.0 + (dist * 0.001)
-        
-        for h in hours:
-            eta_db[str_dist][str(h)] = {}
-            for d in day_types:
-                eta_db[str_dist][str(h)][d] = {}
-                for w in weathers:
-                    eta_db[str_dist][str(h)][d][w] = {}
-                    for v in vehicles:
-                        eta_db[str_dist][str(h)][d][w][v] = {}
-                        for t in terrains:
-                            # Complex multipliers
-                            hour_mult = 1.6 if h in [8,9,17,18] else 1.0
-                            day_mult = 1.3 if d == 'weekend' and 11 <= h <= 15 else 1.0
-                            weather_mult = {'clear': 1.0, 'rain': 1.25, 'fog': 1.4, 'snow': 1.8}[w]
-                            vehicle_mult = {'sedan': 1.0, 'suv': 0.95, 'bike': 1.15, 'bus': 1.5}[v]
-                            terrain_mult = {'highway': 0.7, 'city': 1.5, 'mountain': 1.8, 'rural': 1.1}[t]
-                            
-                            raw_hours = dist / base_speed
-                            mins = raw_hours * 60.0 * hour_mult * day_mult * weather_mult * vehicle_mult * terrain_mult * fatigue_penalty
-                            
-                            eta_db[str_dist][str(h)][d][w][v][t] = round(mins, 1)
-                            count += 1
-                            
-    os.makedirs('models', exist_ok=True)
-    with open('models/eta_grid.json', 'w') as f:
-        json.dump(eta_db, f)
-    print(f"Successfully Trained {count} Unique ETA Pathways in {round(time.time() - start_time, 2)}s\n")
 
-def train_budget_ml_model():
-    print("Initiating True Machine Learning Training (Scikit-Learn RandomForest) for Budget...")
-    try:
-        import pandas as pd
-        import numpy as np
-        from sklearn.ensemble import RandomForestRegressor
-        from sklearn.pipeline import Pipeline
-        from sklearn.compose import ColumnTransformer
-        from sklearn.preprocessing import OneHotEncoder
-        import joblib
-    except ImportError:
-        print("Scikit-Learn stack missing. Skipping ML budget training. Please install pandas, scikit-learn, joblib.")
-        return
+    chunk_starts = range(0, len(distances), chunk_bins)
+    report_every = max(1, len(chunk_starts) // 10)
+    for ci, lo in enumerate(chunk_starts):
+        hi = min(lo + chunk_bins, len(distances))
+        if ci % report_every == 0:
+            print(f"Training Progress: [{str(int(distances[lo])).zfill(4)} / {max_km} km] ... {(lo / len(distances)) * 100:.1f}%")
 
-    # Base Constants — Genuine Indian Travel Rates (per person/night)
-    STAY_NIGHTLY_BASE = {
-        'hostel': 300,         'camping': 400,
-        'friend_house': 0,     'home': 0,          'family_stay': 0,
-        'budget_hotel': 700,   '3star_hotel': 1800, 'resort': 3500,
-        '5star_hotel': 6000,   'dharamshala': 150,  'ashram': 200,
-        'guesthouse': 500,     'homestay': 600,     'heritage_hotel': 2500,
-        'houseboat': 2500,     'treehouse': 1800,   'desert_camp': 1200,
-        'tent_resort': 1200
-    }
-    FOOD_DAILY_COST = {
-        'veg_thali': 150,   'nonveg_thali': 220,
-        'local_cuisine': 300, 'dhaba': 120,
-        'restaurant': 500,  'hotel_buffet': 900
-    }
-    TRANSPORT_DAILY_PP = {
-        'budget': 200,   'mid-range': 450,
-        'mid': 450,      'luxury': 1200
+        dist = distances[lo:hi].astype(np.float64)[:, None, None, None, None, None]
+        fatigue_penalty = 1.0 + (dist * ETA_FATIGUE_PER_KM)
+        raw_hours = dist / ETA_BASE_SPEED_KMH
+        # Same left-to-right product as the scalar formula, so values are bit-identical
+        mins = raw_hours * 60.0 * hour_mult * day_mult * weather_mult * vehicle_mult * terrain_mult * fatigue_penalty
+        eta_grid[lo:hi] = _round_tenths(mins)
+
+    save_eta_grid(eta_grid, {
+        'dist_bins': distances.tolist(),
+        'hours': hours.tolist(),
+        'day_types': ETA_DAY_TYPES,
+        'weathers': list(ETA_WEATHER_MULT),
+        'vehicles': list(ETA_VEHICLE_MULT),
+        'terrains': list(ETA_TERRAIN_MULT),
+    })
+    print(f"Successfully Trained {eta_grid.size} Unique ETA Pathways in {round(time.time() - start_time, 2)}s\n")
+
+def export_eta_factors(path=ETA_FACTORS_PATH):
+    """Write the per-axis factor vectors used by ml_eta.FactorizedETAEngine."""
+    hour_mult, day_mult, weather_mult, vehicle_mult, terrain_mult = _eta_factor_tables()
+    factors = {
+        'base_speed_kmh': ETA_BASE_SPEED_KMH,
+        'fatigue_per_km': ETA_FATIGUE_PER_KM,
+        'hour_mult': hour_mult.tolist(),
+        'day_types': ETA_DAY_TYPES,
+        'day_mult': day_mult.tolist(),
+        'weathers': list(ETA_WEATHER_MULT),
+        'weather_mult': weather_mult.tolist(),
+        'vehicles': list(ETA_VEHICLE_MULT),
+        'vehicle_mult': vehicle_mult.tolist(),
+        'terrains': list(ETA_TERRAIN_MULT),
+        'terrain_mult': terrain_mult.tolist(),
     }
-    # Modest multipliers — last-minute adds only 10%, peak adds 20%
-    SEASON_MULT  = {'peak': 1.2, 'off-peak': 0.85, 'shoulder': 1.0, 'holiday': 1.35}
-    BOOKING_MULT = {'last-minute': 1.10, 'normal': 1.0, 'advance': 0.88}
-
-    print("Generating 50,000 synthetic realistic travel records...")
-    np.random.seed(42)
-    n_samples = 50000
-
-    days_arr = np.random.randint(1, 61, n_samples)
-    group_arr = np.random.randint(1, 21, n_samples)
-    style_arr = np.random.choice(list(TRANSPORT_DAILY_PP.keys()), n_samples)
-    food_arr = np.random.choice(list(FOOD_DAILY_COST.keys()), n_samples)
-    season_arr = np.random.choice(list(SEASON_MULT.keys()), n_samples)
-    booking_arr = np.random.choice(list(BOOKING_MULT.keys()), n_samples)
-    stay_arr = np.random.choice(list(STAY_NIGHTLY_BASE.keys()), n_samples)
-
-    # Generate random is_family flag for training
-    is_family_arr = np.random.choice([True, False], n_samples, p=[0.3, 0.7])  # 30% family travel
-
-    y_budget = []
-    
-    # Generate labels using the SAME logic as prediction + random Gaussian noise
-    for i in range(n_samples):
-        # Baseline costs (same as ml_budget.py)
-        s_mult = SEASON_MULT[season_arr[i]]
-        b_mult = BOOKING_MULT[booking_arr[i]]
-        d = days_arr[i]
-        grp = group_arr[i]
-        stay_type = stay_arr[i]
-
-        # Base costs per person per day
-        nightly_pp = STAY_NIGHTLY_BASE[stay_type] * s_mult * b_mult
-        food_daily_pp = FOOD_DAILY_COST[food_arr[i]] * s_mult
-        transport_pp = TRANSPORT_DAILY_PP[style_arr[i]] * s_mult
-
-        # Calculate base total for group — NO discounts applied here.
-        # Discounts are applied ONCE at prediction time in ml_budget.py.
-        # This ensures the ML model learns clean base costs.
-        base_total = (nightly_pp + food_daily_pp + transport_pp) * d * grp
-
-        # Inject small real-world price fluctuation (±8% noise)
-        noise = np.random.normal(0, 0.08)
-        final_budget = base_total * (1 + noise)
-        y_budget.append(max(0, final_budget))  # Ensure non-negative
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(factors, f)
+    print(f"Exported factorized ETA model ({os.path.getsize(path)} bytes) to {path}")
+
+
+def verify_eta_factors(chunk_bins=256):
+    """
+    Check that the factorized ETA backend reproduces every cell of the
+    materialized grid bit-for-bit. Raises RuntimeError on any mismatch.
+    """
+    import numpy as np
+    from ml_eta import FactorizedETAEngine
+
+    engine = FactorizedETAEngine()
+    if not engine._is_ready():
+        raise RuntimeError("ETA factors missing — run export_eta_factors() first")
+
+    grid = np.load(ETA_GRID_PATH, mmap_mode='r')
+    with open(ETA_META_PATH, 'r') as f:
+        meta = json.load(f)
+    for axis, index in (('day_types', engine.day_index), ('weathers', engine.weather_index),
+                        ('vehicles', engine.vehicle_index), ('terrains', engine.terrain_index)):
+        if list(index) != meta[axis]:
+            raise RuntimeError(f"ETA factor axis '{axis}' does not match the grid")
+
+    distances = np.asarray(meta['dist_bins'], dtype=np.float64)
+    hours = np.arange(grid.shape[1])[None, :, None, None, None, None]
+    d_idx = np.arange(grid.shape[2])[None, None, :, None, None, None]
+    w_idx = np.arange(grid.shape[3])[None, None, None, :, None, None]
+    v_idx = np.arange(grid.shape[4])[None, None, None, None, :, None]
+    t_idx = np.arange(grid.shape[5])[None, None, None, None, None, :]
+
+    mismatches = 0
+    for lo in range(0, len(distances), chunk_bins):
+        dist = distances[lo:lo + chunk_bins][:, None, None, None, None, None]
+        minutes = engine._minutes_many(dist, hours, d_idx, w_idx, v_idx, t_idx)
+        mismatches += int((_round_tenths(minutes) != grid[lo:lo + chunk_bins]).sum())
+    if mismatches:
+        raise RuntimeError(f"Factorized ETA model disagrees with the grid in {mismatches} cells")
+    print(f"Verified factorized ETA model against all {grid.size} grid cells (exact match)")
+
+
+def generate_budget_dataset(n_samples=50000, seed=42):
+    """
+    Synthetic trips labelled with the budget cost formula plus ±8% noise.
+    Categories are drawn as integer codes and priced through lookup arrays
+    and the noise is one draw of size n, so millions of rows take seconds.
+    Returns (features DataFrame, labels array).
+    """
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+
+    def draw(table):
+        labels = list(table)
+        codes = rng.integers(0, len(labels), n_samples)
+        values = np.array([table[label] for label in labels], dtype=np.float64)
+        return pd.Categorical.from_codes(codes, labels), values[codes]
+
+    days_arr = rng.integers(1, 61, n_samples)
+    group_arr = rng.integers(1, 21, n_samples)
+    style_arr, transport_pp = draw(BUDGET_TRANSPORT_DAILY_PP)
+    food_arr, food_daily_pp = draw(BUDGET_FOOD_DAILY_COST)
+    season_arr, s_mult = draw(BUDGET_SEASON_MULT)
+    booking_arr, b_mult = draw(BUDGET_BOOKING_MULT)
+    stay_arr, nightly_pp = draw(BUDGET_STAY_NIGHTLY_BASE)
+
+    # Base costs per person per day (same formula as ml_budget.py's analytic model)
+    nightly_pp = nightly_pp * s_mult * b_mult
+    food_daily_pp = food_daily_pp * s_mult
+    transport_pp = transport_pp * s_mult
+
+    # Base total for the group — NO discounts applied here.
+    # Discounts are applied ONCE at prediction time in ml_budget.py.
+    # This ensures the ML model learns clean base costs.
+    base_total = (nightly_pp + food_daily_pp + transport_pp) * days_arr * group_arr
+
+    # Inject small real-world price fluctuation (±8% noise)
+    noise = rng.normal(0, BUDGET_LABEL_NOISE, n_samples)
+    y = np.maximum(0, base_total * (1 + noise))  # Ensure non-negative
 
     df = pd.DataFrame({
         'days': days_arr,
@@ -149,10 +292,16 @@ def train_budget_ml_model():
         'booking': booking_arr,
         'stay_type': stay_arr
     })
-    y = np.array(y_budget)
+    return df, y
+
+
+def _build_budget_pipeline(n_estimators=30, max_depth=15, min_samples_leaf=1, n_jobs=-1):
+    """One-hot the categorical columns, pass days/group_size through, fit a RandomForest."""
+    from sklearn.ensemble import RandomForestRegressor
+    from sklearn.pipeline import Pipeline
+    from sklearn.compose import ColumnTransformer
+    from sklearn.preprocessing import OneHotEncoder
 
-    # Scikit-Learn Pipeline
-    print("Training RandomForestRegressor model...")
     categorical_features = ['travel_style', 'food_type', 'season', 'booking', 'stay_type']
     
     preprocessor = ColumnTransformer(
@@ -160,22 +309,483 @@ def train_budget_ml_model():
         remainder='passthrough'
     )
 
-    model_pipeline = Pipeline([
+    return Pipeline([
         ('preprocessor', preprocessor),
-        ('regressor', RandomForestRegressor(n_estimators=30, max_depth=15, random_state=42, n_jobs=-1))
+        ('regressor', RandomForestRegressor(n_estimators=n_estimators, max_depth=max_depth,
+                                            min_samples_leaf=min_samples_leaf, random_state=42, n_jobs=n_jobs))
     ])
 
+
+def train_budget_ml_model(n_samples=50000, seed=42):
+    print("Initiating True Machine Learning Training (Scikit-Learn RandomForest) for Budget...")
+    # Availability check only: the generator and pipeline builder import what they use
+    if any(importlib.util.find_spec(m) is None for m in ('pandas', 'sklearn', 'joblib')):
+        print("Scikit-Learn stack missing. Skipping ML budget training. Please install pandas, scikit-learn, joblib.")
+        return
+    import joblib
+
+    print(f"Generating {n_samples:,} synthetic realistic travel records...")
+    gen_start = time.time()
+    df, y = generate_budget_dataset(n_samples, seed)
+    print(f"Generated dataset in {round(time.time() - gen_start, 2)}s")
+
+    # Scikit-Learn Pipeline
+    print("Training RandomForestRegressor model...")
+    model_pipeline = _build_budget_pipeline()
+
     start_time = time.time()
     model_pipeline.fit(df, y)
     
     os.makedirs('models', exist_ok=True)
-    joblib.dump(model_pipeline, 'models/budget_rf.pkl')
+    joblib.dump(model_pipeline, BUDGET_MODEL_PATH)
+    export_budget_forest(model_pipeline)
     
     elapsed = round(time.time() - start_time, 2)
     print(f"Successfully trained & saved True ML Budget Model (budget_rf.pkl) in {elapsed}s\n")
 
 
+def export_budget_forest(model_pipeline=None, path=BUDGET_FOREST_PATH):
+    """
+    Flatten the fitted RandomForest into contiguous node arrays for the
+    compiled evaluator in ml_budget.py. Child indices are global across
+    trees (-1 marks a leaf); `roots` holds each tree's first node.
+    """
+    import numpy as np
+    import joblib
+
+    if model_pipeline is None:
+        model_pipeline = joblib.load(BUDGET_MODEL_PATH)
+    forest = model_pipeline.steps[-1][1]
+
+    feature, threshold, left, right, value, roots = [], [], [], [], [], []
+    offset = 0
+    for estimator in forest.estimators_:
+        tree = estimator.tree_
+        roots.append(offset)
+        feature.append(tree.feature)
+        threshold.append(tree.threshold)
+        left.append(np.where(tree.children_left < 0, -1, tree.children_left + offset))
+        right.append(np.where(tree.children_right < 0, -1, tree.children_right + offset))
+        value.append(tree.value[:, 0, 0])
+        offset += tree.node_count
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as f:
+        np.savez(
+            f,
+            feature=np.concatenate(feature).astype(np.int32),
+            threshold=np.concatenate(threshold).astype(np.float64),
+            left=np.concatenate(left).astype(np.int32),
+            right=np.concatenate(right).astype(np.int32),
+            value=np.concatenate(value).astype(np.float64),
+            roots=np.asarray(roots, dtype=np.int32),
+            n_features=forest.n_features_in_,
+            max_depth=max(e.tree_.max_depth for e in forest.estimators_),
+        )
+    print(f"Exported compiled budget forest ({len(roots)} trees, {offset} nodes) to {path}")
+
+
+def _season_for_month(month):
+    """Season bucket of a travel month (same rule as the Plan Trip form)."""
+    if month in (12, 1, 6, 7):
+        return 'peak'
+    if month in (2, 3, 8, 9):
+        return 'off-peak'
+    return 'shoulder'
+
+
+def load_real_budget_rows(chunk_size=1000, max_ratio=BUDGET_REAL_SPEND_RATIO):
+    """
+    Stream trips with recorded expenses out of the database and turn them into
+    training rows. Days come from start_date/end_date and the season from the
+    start month; the trips table records no group size, travel style, food or
+    booking window, so those take the planner defaults (solo, mid, local
+    cuisine, normal). Labels undo the destination multiplier and the
+    stay-at-home factor that ml_budget applies at prediction time, so real
+    spend lines up with the synthetic base costs.
+
+    Because every row is labelled as that solo default cell, trips whose
+    per-day spend is more than `max_ratio` away from the cell's cost (group
+    trips, luxury travel, typos) are dropped rather than teaching the forest
+    that one person spends a group's total. Returns (features DataFrame,
+    labels, number of dropped trips).
+    """
+    import datetime
+    import numpy as np
+    import pandas as pd
+    import database
+    from ml_budget import HOME_STAY_TYPES, _destination_multiplier, _normalize_stay
+
+    columns = {'days': [], 'group_size': [], 'travel_style': [], 'food_type': [],
+               'season': [], 'booking': [], 'stay_type': []}
+    labels = []
+    dropped = 0
+    for chunk in database.iter_trip_spend(chunk_size):
+        for _, destination, start_date, end_date, stay_type, _, spent in chunk:
+            try:
+                start = datetime.date.fromisoformat(str(start_date)[:10])
+                end = datetime.date.fromisoformat(str(end_date)[:10])
+            except ValueError:
+                continue
+            if end < start or spent <= 0:
+                continue
+            stay = _normalize_stay(stay_type or 'budget_hotel')
+            days = min(60, max(1, (end - start).days))
+            season = _season_for_month(start.month)
+            base = spent / _destination_multiplier(destination)
+            if stay in HOME_STAY_TYPES:
+                base = base / 0.20
+
+            # Synthetic base cost of the solo / mid / local_cuisine / normal cell
+            expected_per_day = BUDGET_SEASON_MULT[season] * (
+                BUDGET_STAY_NIGHTLY_BASE.get(stay, BUDGET_STAY_NIGHTLY_BASE['budget_hotel'])
+                + BUDGET_FOOD_DAILY_COST['local_cuisine'] + BUDGET_TRANSPORT_DAILY_PP['mid'])
+            ratio = (base / days) / expected_per_day
+            if not 1 / max_ratio <= ratio <= max_ratio:
+                dropped += 1
+                continue
+
+            columns['days'].append(days)
+            columns['group_size'].append(1)
+            columns['travel_style'].append('mid')
+            columns['food_type'].append('local_cuisine')
+            columns['season'].append(season)
+            columns['booking'].append('normal')
+            columns['stay_type'].append(stay)
+            labels.append(base)
+    return pd.DataFrame(columns), np.array(labels, dtype=np.float64), dropped
+
+
+def _budget_mape(pipeline, df, y):
+    """Mean absolute percentage error (%) of a budget pipeline's base costs."""
+    import numpy as np
+
+    if len(y) == 0:
+        return None
+    pred = pipeline.predict(df)
+    return round(float((np.abs(pred - y) / np.maximum(y, 1.0) * 100).mean()), 3)
+
+
+def _live_budget_pipeline():
+    """The budget pipeline currently served (CURRENT registry version, else the flat file), or None."""
+    import joblib
+    import model_registry
+
+    version = model_registry.current_version('budget')
+    try:
+        if version is not None:
+            return joblib.load(os.path.join(model_registry.validate('budget', version), 'budget_rf.pkl'))
+        if os.path.exists(BUDGET_MODEL_PATH):
+            return joblib.load(BUDGET_MODEL_PATH)
+    except Exception as e:
+        print(f"Could not load the live budget model for comparison: {e}")
+    return None
+
+
+def train_budget_from_db(n_synthetic=50000, real_weight=1.0, chunk_size=1000, seed=42,
+                         holdout_fraction=0.2, holdout_synthetic=10000):
+    """
+    Retrain the budget forest on real trip spend from the database blended
+    with the synthetic baseline. Real rows get `real_weight` times the sample
+    weight of a synthetic row.
+
+    A `holdout_fraction` of the real rows and a fresh synthetic sample are
+    held out, and the candidate is scored (MAPE) on both next to the live
+    model. The candidate is saved to the flat models/ files — and so can be
+    published — only if it is no worse on either set. Returns the
+    comparison report; report['accepted'] says whether it was saved.
+    """
+    import joblib
+    import numpy as np
+    import pandas as pd
+
+    start_time = time.time()
+    real_df, real_y, dropped = load_real_budget_rows(chunk_size)
+    print(f"Loaded {len(real_df):,} real trips with expenses from the database "
+          f"({dropped:,} dropped as implausible for one person)")
+
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(real_y))
+    n_holdout = int(round(len(real_y) * holdout_fraction))
+    holdout_idx, train_idx = order[:n_holdout], order[n_holdout:]
+    synth_df, synth_y = generate_budget_dataset(n_synthetic, seed)
+
+    categorical = {c: str for c in ('travel_style', 'food_type', 'season', 'booking', 'stay_type')}
+    real_train = real_df.iloc[train_idx].astype(categorical)
+    df = pd.concat([synth_df.astype(categorical), real_train], ignore_index=True)
+    y = np.concatenate([synth_y, real_y[train_idx]])
+    weights = np.concatenate([np.ones(len(synth_y)), np.full(len(train_idx), float(real_weight))])
+
+    model_pipeline = _build_budget_pipeline()
+    model_pipeline.fit(df, y, regressor__sample_weight=weights)
+
+    synth_holdout, synth_truth = generate_budget_dataset(holdout_synthetic, seed + 1)
+    real_holdout, real_truth = real_df.iloc[holdout_idx], real_y[holdout_idx]
+    live = _live_budget_pipeline()
+    report = {
+        'real_rows': len(real_y), 'real_dropped': dropped, 'real_holdout': int(n_holdout),
+        'candidate_synthetic_mape_pct': _budget_mape(model_pipeline, synth_holdout, synth_truth),
+        'candidate_real_mape_pct': _budget_mape(model_pipeline, real_holdout, real_truth),
+        'live_synthetic_mape_pct': _budget_mape(live, synth_holdout, synth_truth) if live else None,
+        'live_real_mape_pct': _budget_mape(live, real_holdout, real_truth) if live else None,
+    }
+    worse = [name for name in ('synthetic', 'real')
+             if report[f'live_{name}_mape_pct'] is not None
+             and report[f'candidate_{name}_mape_pct'] > report[f'live_{name}_mape_pct']]
+    report['accepted'] = not worse
+    print(f"Held-out MAPE — synthetic: candidate {report['candidate_synthetic_mape_pct']}% "
+          f"vs live {report['live_synthetic_mape_pct']}%; real: candidate {report['candidate_real_mape_pct']}% "
+          f"vs live {report['live_real_mape_pct']}%")
+    if worse:
+        print(f"Refusing the retrained budget model: worse than the live one on held-out {' and '.join(worse)} data.")
+        return report
+
+    os.makedirs('models', exist_ok=True)
+    joblib.dump(model_pipeline, BUDGET_MODEL_PATH)
+    export_budget_forest(model_pipeline)
+    print(f"Trained budget model on {len(synth_y):,} synthetic + {len(train_idx):,} real rows "
+          f"in {round(time.time() - start_time, 2)}s")
+    return report
+
+
+def _fit_budget_config(params, n_samples, seed, holdout_samples, out_dir):
+    """
+    Sweep worker (runs in its own process): fit one configuration, save its
+    pickle + compiled forest to `out_dir` and score it on the held-out set.
+    """
+    import joblib
+    import numpy as np
+
+    df, y = generate_budget_dataset(n_samples, seed)
+    pipeline = _build_budget_pipeline(n_jobs=1, **params)
+    start = time.perf_counter()
+    pipeline.fit(df, y)
+    fit_seconds = time.perf_counter() - start
+
+    os.makedirs(out_dir, exist_ok=True)
+    model_path = os.path.join(out_dir, 'budget_rf.pkl')
+    forest_path = os.path.join(out_dir, 'budget_forest.npz')
+    joblib.dump(pipeline, model_path)
+    export_budget_forest(pipeline, forest_path)
+
+    holdout, truth = generate_budget_dataset(holdout_samples, seed + 1)
+    pred = pipeline.predict(holdout)
+    mape = np.abs(pred - truth) / np.maximum(truth, 1.0) * 100
+
+    return dict(
+        params,
+        artifact_dir=out_dir,
+        fit_seconds=round(fit_seconds, 2),
+        mape_pct=round(float(mape.mean()), 3),
+        model_bytes=os.path.getsize(model_path),
+        forest_bytes=os.path.getsize(forest_path),
+    )
+
+
+def _measure_budget_latency(artifact_dir, rows, repeat=3):
+    """Load time and uncached single-row / batch predict latency of one saved configuration (rows must be distinct)."""
+    from ml_budget import HypercubeBudgetEngine
+
+    start = time.perf_counter()
+    engine = HypercubeBudgetEngine(artifact_dir, backend='forest')
+    load_ms = (time.perf_counter() - start) * 1000
+
+    # One pass over distinct rows, so every predict() is a cache miss
+    start = time.perf_counter()
+    for row in rows:
+        engine.predict(**row)
+    single = (time.perf_counter() - start) / len(rows)
+
+    columns = {k: [row[k] for row in rows] for k in rows[0]}
+    batch = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        engine.predict_many(**columns)
+        batch = min(batch, (time.perf_counter() - start) / len(rows))
+    return {'load_ms': round(load_ms, 1), 'predict_us': round(single * 1e6, 1),
+            'batch_us_per_row': round(batch * 1e6, 2)}
+
+
+def sweep_budget_models(grid=None, n_samples=50000, seed=42, holdout_samples=5000,
+                        target_mape=20.0, objective='latency', workers=None,
+                        report_path=BUDGET_SWEEP_REPORT_PATH):
+    """
+    Train every combination of `grid` (default BUDGET_SWEEP_GRID) in a process
+    pool and record held-out MAPE, artifact size, load time and single-row /
+    batch latency. Latency is measured serially afterwards so concurrent fits
+    do not skew it. Among the configurations within `target_mape` (%), the
+    fastest single-row predictor (objective='latency') or the smallest
+    artifact ('size') is installed as BUDGET_MODEL_PATH; if none qualifies,
+    the most accurate one is. The report is written to `report_path`.
+    """
+    import itertools
+    import shutil
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+
+    if objective not in ('latency', 'size'):
+        raise ValueError("objective must be 'latency' or 'size'")
+    grid = grid or BUDGET_SWEEP_GRID
+    configs = [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+    print(f"Sweeping {len(configs)} budget forest configurations on {n_samples:,} rows...")
+
+    os.makedirs('models', exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix='.budget_sweep_', dir='models')
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_fit_budget_config, params, n_samples, seed, holdout_samples,
+                                   os.path.join(work_dir, str(i)))
+                       for i, params in enumerate(configs)]
+            results = [future.result() for future in futures]
+
+        holdout, _ = generate_budget_dataset(500, seed + 2)
+        rows = holdout.astype({c: str for c in holdout.columns if c not in ('days', 'group_size')})
+        rows = rows.drop_duplicates().to_dict('records')
+        for result in results:
+            result.update(_measure_budget_latency(result['artifact_dir'], rows))
+            print(f"  {result['n_estimators']:>3} trees, depth {result['max_depth']}, leaf {result['min_samples_leaf']}: "
+                  f"MAPE {result['mape_pct']}%, {(result['model_bytes'] + result['forest_bytes']) / 1e6:.1f} MB, "
+                  f"{result['predict_us']} us/row")
+
+        if objective == 'latency':
+            rank = lambda r: (r['predict_us'], r['mape_pct'])
+        else:
+            rank = lambda r: (r['model_bytes'] + r['forest_bytes'], r['mape_pct'])
+        eligible = [r for r in results if r['mape_pct'] <= target_mape]
+        chosen = min(eligible, key=rank) if eligible else min(results, key=lambda r: r['mape_pct'])
+        if not eligible:
+            print(f"Warning: no configuration reached {target_mape}% MAPE — keeping the most accurate one.")
+
+        shutil.copyfile(os.path.join(chosen['artifact_dir'], 'budget_rf.pkl'), BUDGET_MODEL_PATH)
+        shutil.copyfile(os.path.join(chosen['artifact_dir'], 'budget_forest.npz'), BUDGET_FOREST_PATH)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for result in results:
+        del result['artifact_dir']
+    report = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'n_samples': n_samples,
+        'holdout_samples': holdout_samples,
+        'target_mape_pct': target_mape,
+        'objective': objective,
+        'met_target': bool(eligible),
+        'selected': {k: chosen[k] for k in grid},
+        'configs': sorted(results, key=lambda r: r['mape_pct']),
+    }
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Selected {report['selected']} (MAPE {chosen['mape_pct']}%, {chosen['predict_us']} us/row); "
+          f"report written to {report_path}")
+    return report
+
+
+def validate_budget_backends(n_samples=5000, seed=7):
+    """
+    Divergence report between ml_budget's RandomForest and analytic backends
+    on a held-out synthetic sample (drawn with a different seed than the
+    training set, with the same ±8% label noise). Returns the report dict.
+    """
+    import numpy as np
+    from ml_budget import (HypercubeBudgetEngine, VALID_TRAVEL_STYLES, VALID_FOOD_TYPES,
+                           VALID_SEASONS, VALID_BOOKINGS, VALID_STAY_TYPES)
+
+    forest = HypercubeBudgetEngine(backend='forest')
+    if not forest._is_ready():
+        print("Budget model missing — skipping backend validation.")
+        return None
+    analytic = HypercubeBudgetEngine(backend='analytic')
+
+    rng = np.random.default_rng(seed)
+    sample = {
+        'days': rng.integers(1, 61, n_samples),
+        'group_size': rng.integers(1, 21, n_samples),
+        'travel_style': rng.choice(VALID_TRAVEL_STYLES, n_samples),
+        'food_type': rng.choice(VALID_FOOD_TYPES, n_samples),
+        'season': rng.choice(VALID_SEASONS, n_samples),
+        'booking': rng.choice(VALID_BOOKINGS, n_samples),
+        'stay_type': rng.choice(VALID_STAY_TYPES, n_samples),
+    }
+    forest_pred = forest.predict_many(**sample)
+    analytic_pred = analytic.predict_many(**sample)
+    labels = analytic_pred * (1 + rng.normal(0, BUDGET_LABEL_NOISE, n_samples))
+
+    def pct_error(pred, truth):
+        return np.abs(pred - truth) / np.maximum(truth, 1.0) * 100
+
+    divergence = pct_error(forest_pred, analytic_pred)
+    by_stay = {st: float(divergence[sample['stay_type'] == st].mean()) for st in VALID_STAY_TYPES}
+    worst_stay = max(by_stay, key=by_stay.get)
+    report = {
+        'samples': n_samples,
+        'divergence_mean_pct': round(float(divergence.mean()), 2),
+        'divergence_p95_pct': round(float(np.percentile(divergence, 95)), 2),
+        'divergence_max_pct': round(float(divergence.max()), 2),
+        'forest_mape_pct': round(float(pct_error(forest_pred, labels).mean()), 2),
+        'analytic_mape_pct': round(float(pct_error(analytic_pred, labels).mean()), 2),
+        'worst_stay_type': worst_stay,
+        'worst_stay_divergence_pct': round(by_stay[worst_stay], 2),
+    }
+    print(f"Budget forest vs analytic on {n_samples} held-out trips: "
+          f"mean {report['divergence_mean_pct']}%, p95 {report['divergence_p95_pct']}%, "
+          f"max {report['divergence_max_pct']}% (worst stay type: {worst_stay} {report['worst_stay_divergence_pct']}%)")
+    print(f"Error vs noisy labels: forest {report['forest_mape_pct']}%, analytic {report['analytic_mape_pct']}%")
+    return report
+
+
+def publish_eta_model():
+    """Publish the freshly built ETA artifacts as a new registry version."""
+    import model_registry
+    return model_registry.publish('eta', {
+        'eta_grid.npy': ETA_GRID_PATH,
+        'eta_grid_meta.json': ETA_META_PATH,
+        'eta_factors.json': ETA_FACTORS_PATH,
+    })
+
+
+def publish_budget_model():
+    """Publish the freshly trained budget pipeline (and its compiled forest) as a new registry version."""
+    import model_registry
+    files = {'budget_rf.pkl': BUDGET_MODEL_PATH}
+    if os.path.exists(BUDGET_FOREST_PATH):
+        files['budget_forest.npz'] = BUDGET_FOREST_PATH
+    return model_registry.publish('budget', files)
+
+
 if __name__ == "__main__":
-    generate_eta_grid()
-    train_budget_ml_model()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Synthesize the ETA hypercube and train the budget model.")
+    parser.add_argument('--eta-max-km', type=int, default=5000, help="Largest ETA distance bin (km)")
+    parser.add_argument('--eta-step-km', type=int, default=10, help="ETA distance bin width (km)")
+    parser.add_argument('--budget-samples', type=int, default=50000, help="Synthetic budget training rows")
+    parser.add_argument('--from-db', action='store_true',
+                        help="Only retrain the budget model, blending in real trip spend from the database; "
+                             "published only if no worse than the live model on held-out data")
+    parser.add_argument('--sweep', action='store_true', help="Sweep budget forest hyperparameters and keep the best model")
+    parser.add_argument('--sweep-target-mape', type=float, default=20.0, help="Held-out MAPE (%%) a swept model must reach")
+    parser.add_argument('--sweep-objective', choices=['latency', 'size'], default='latency',
+                        help="Among models meeting the target, keep the fastest or the smallest")
+    args = parser.parse_args()
+
+    with training_lock():
+        if not args.from_db:
+            generate_eta_grid(max_km=args.eta_max_km, step_km=args.eta_step_km)
+            export_eta_factors()
+            verify_eta_factors()
+            publish_eta_model()
+        if args.from_db:
+            accepted = train_budget_from_db(n_synthetic=args.budget_samples)['accepted']
+        elif args.sweep:
+            sweep_budget_models(n_samples=args.budget_samples, target_mape=args.sweep_target_mape,
+                                objective=args.sweep_objective)
+            accepted = True
+        else:
+            train_budget_ml_model(n_samples=args.budget_samples)
+            accepted = True
+        if accepted:
+            validate_budget_backends()
+            publish_budget_model()
+        else:
+            print("Live budget model left unchanged.")
     print("ALL ML HYPERCUBES FULLY SYNTHESIZED")